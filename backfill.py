@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''backfill
+Export the history of an account to a JSONL archive, and optionally post it:
+    python backfill.py SCREEN_NAME [--out SCREEN_NAME.jsonl.gz] [--post --interval 120]
+The timeline is paged with max_id and written tweet by tweet
+(tweet.TweetRecord.toDict), so memory stays flat however long it is.
+Every `CHECKPOINT` tweets the archive is flushed and the position saved in
+<out>.checkpoint.json, an interrupted run goes on from there.
+An archive ending with .gz is gzip compressed, one gzip member per checkpoint.
+--post posts the archive oldest first, one tweet every `--interval` seconds,
+through its own outbox and the FILTER and dedup index of main.
+'''
+
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+
+import store
+import tweet
+
+CHECKPOINT = 200  # tweets
+INTERVAL = 120  # second between two posts, weibo limits frequent posting
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='export (and post) the history of an account')
+    parser.add_argument('screenName', metavar='SCREEN_NAME')
+    parser.add_argument('--out', help='archive, SCREEN_NAME.jsonl.gz by default')
+    parser.add_argument('--post', action='store_true', help='post the archive, oldest first')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help='second between two posts')
+    parser.add_argument('--outbox', help='outbox of --post, <out>.outbox.db by default')
+    return parser.parse_args(argv)
+
+
+class Archive(object):
+    """append only JSONL file, gzip compressed when the path ends with .gz"""
+
+    def __init__(self, path, offset=0):
+        '''
+        offset: end of the last commit, anything written after it is dropped
+        '''
+        super(Archive, self).__init__()
+        self.path = path
+        self.compress = path.endswith('.gz')
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.member = None
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        if not self.compress:
+            self.file.write(line)
+            return
+        if self.member is None:
+            self.member = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self.member.write(line)
+
+    def commit(self) -> int:
+        '''
+        make what was written durable
+        return: offset to resume from
+        '''
+        if self.member is not None:
+            # a complete gzip member, the file can be cut back to here
+            self.member.close()
+            self.member = None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+
+def readSegment(path, start, end) -> list:
+    '''
+    records written between two commits
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if path.endswith('.gz'):
+        data = gzip.decompress(data)
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+
+def export(tweetClient, screenName, path, state) -> int:
+    '''
+    page the timeline into the archive from the checkpoint on
+    state: store.StateFile of the checkpoint
+    return: number of tweets in the archive
+    '''
+    if state.get('done'):
+        return state.get('count', 0)
+    # start offsets of the committed segments, newest first
+    segments = state.get('segments', [])
+    archive = Archive(path, offset=state.get('offset', 0))
+    count = state.get('count', 0)
+    n = 0
+    lastId = None
+
+    def commit():
+        offset = archive.commit()
+        if offset > state.get('offset', 0):
+            segments.append(state.get('offset', 0))
+        state.data.update(offset=offset, count=count, maxId=lastId - 1, segments=segments)
+        state.save()
+        logging.info('{} - {} tweets archived'.format(screenName, count))
+
+    try:
+        for t in tweetClient.iterTimeline(screenName, maxId=state.get('maxId')):
+            archive.write(t.toDict())
+            count += 1
+            n += 1
+            lastId = t.id
+            if n % CHECKPOINT == 0:
+                commit()
+        if lastId is not None and n % CHECKPOINT:
+            commit()
+        state.set('done', True)
+    finally:
+        archive.file.close()
+    return count
+
+
+def post(app, screenName, path, state, interval):
+    '''
+    queue the archive segment by segment, oldest first, and post it slowly
+    app: main, after init()
+    '''
+    segments = state.get('segments', [])
+    ends = segments[1:] + [state.get('offset', 0)]
+    posted = 0
+    for i in range(state.get('queued', 0), len(segments)):
+        # segments are newest first
+        k = len(segments) - 1 - i
+        records = readSegment(path, segments[k], ends[k])
+        records.reverse()
+        app.enqueue(screenName, [tweet.TweetRecord.fromDict(r) for r in records])
+        posted += drain(app, interval)
+        state.set('queued', i + 1)
+    return posted + drain(app, interval)
+
+
+def drain(app, interval) -> int:
+    posted = 0
+    while app.tweetOutbox.depth():
+        if app.drain(limit=1):
+            posted += 1
+            time.sleep(interval)
+        else:
+            # waiting for a retry
+            time.sleep(1)
+    return posted
+
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    path = args.out or '{}.jsonl.gz'.format(args.screenName)
+    state = store.StateFile(path + '.checkpoint.json')
+    if state.get('screenName', args.screenName) != args.screenName:
+        raise Exception('{} is the archive of {}'.format(path, state.get('screenName')))
+    state.set('screenName', args.screenName)
+
+    import main as app
+    import outbox
+    if args.post:
+        app.init()
+        # not the outbox of the running main.py, it would post at full speed
+        app.tweetOutbox.close()
+        app.tweetOutbox = outbox.Outbox(args.outbox or path + '.outbox.db')
+        tweetClient = app.tweetClient
+    else:
+        tweetClient = app.getTweetClient(app.config, app.getCredentials(app.config))
+
+    count = export(tweetClient, args.screenName, path, state)
+    logging.info('{} - archive {} done, {} tweets'.format(args.screenName, path, count))
+    if args.post:
+        n = post(app, args.screenName, path, state, args.interval)
+        logging.info('{} - posted {}'.format(args.screenName, n))
+        app.mediaPipeline.shutdown()
+        app.tweetOutbox.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
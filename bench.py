@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''bench
+End to end benchmark of main.loop against the local stubs in stubs.py,
+no network or credentials needed:
+    python bench.py --accounts 4 --tweets 5 --photos 2 --latency 0.02
+Reports tweets/sec, stage latency percentiles (from metrics) and requests
+per tweet per endpoint. --max-requests fails the run when a tweet costs more
+round trips than that, to catch regressions before they ship.
+--record saves the traffic (see capture.py), --replay runs again from it
+without the stubs for a deterministic comparison.
+--stream checks stream.Stream instead: the stub answers a 429, drops a
+connection and stalls one, the stream must come back every time and, with
+polling while it is down like main.main, no published tweet is missed.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import argparse
+import tempfile
+import importlib.util
+
+import stubs
+
+QUANTILES = (0.5, 0.9, 0.99)
+STREAM_PLAN = (429, 'drop', 'stall')
+TICK = 0.1  # second between two published tweets of --stream
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='benchmark main.loop against local stubs')
+    parser.add_argument('--backend', choices=('mweibo', 'weibo'), default='mweibo',
+                        help='weibo H5 (WEIBO_COOKIE) or weibo API (WEIBO_ACCESS_TOKEN)')
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--tweets', type=int, default=5, help='new tweets per account per cycle')
+    parser.add_argument('--photos', type=int, default=1, help='photos per tweet')
+    parser.add_argument('--photo-size', type=int, default=64 * 1024, help='byte')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0, help='second per request')
+    parser.add_argument('--error-rate', type=float, default=0, help='0 ~ 1 per request')
+    parser.add_argument('--cache', action='store_true', help='enable MEDIA_CACHE')
+    parser.add_argument('--hedge', type=float, default=None, help='HEDGE_PERCENTILE')
+    parser.add_argument('--record', help='record the traffic to this JSONL file')
+    parser.add_argument('--replay', help='answer from a file written by --record instead of the stubs')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed, 1 original timing, 0 no waiting')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--max-requests', type=float, default=None,
+                        help='exit 1 if requests per tweet is higher')
+    parser.add_argument('--stream', type=float, default=None, metavar='SECONDS',
+                        help='check the filtered stream for this long instead')
+    parser.add_argument('--heartbeat', type=float, default=2, help='second, --stream')
+    parser.add_argument('--keep-alive', type=float, default=0.5, help='second, --stream')
+    parser.add_argument('--drop-after', type=float, default=2,
+                        help='second a dropped or stalled connection lasts, --stream')
+    return parser.parse_args(argv)
+
+
+def loadConfig(args, workdir, stub):
+    '''
+    config.sample.py with bench settings, installed as the `config` module
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.sample.py')
+    spec = importlib.util.spec_from_file_location('config', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules['config'] = module
+    settings = {
+        'DEBUG': False,
+        'SCREEN_NAME': stub.screenNames,
+        'LIST_ID': None,
+        'PROXY': None,
+        'STREAM': False,
+        'FILTER': None,
+        'STATE_FILE': os.path.join(workdir, 'state.json'),
+        'CREDENTIALS_FILE': os.path.join(workdir, 'credentials.json'),
+        'TWITTER_API_KEY': 'bench',
+        'TWITTER_API_SECRET': 'bench',
+        'TWITTER_BEARER_TOKEN': None,
+        'WEIBO_COOKIE': 'bench' if args.backend == 'mweibo' else None,
+        'WEIBO_ACCESS_TOKEN': 'bench' if args.backend == 'weibo' else None,
+        'WEIBO_APP_ID': 'bench',
+        'WEIBO_APP_SECRET': 'bench',
+        'WEIBO_REDIRECT_URI': None,
+        'MEDIA_CACHE': os.path.join(workdir, 'cache') if args.cache else None,
+        'HEDGE_PERCENTILE': args.hedge,
+        'OUTBOX': os.path.join(workdir, 'outbox.db'),
+        'OUTBOX_BACKOFF': 0,
+        'METRICS_PORT': None,
+        'METRICS_FILE': None
+    }
+    for key, value in settings.items():
+        setattr(module.config, key, value)
+    return module.config
+
+
+def endpoint(key) -> str:
+    '''
+    capture.requestKey -> stubs.Stub.endpoint name
+    '''
+    method, url = key.split(' ', 1)
+    path = url.split('?')[0]
+    if path.startswith('pbs.twimg.com/'):
+        return 'photo'
+    return '{} {}'.format(method, path)
+
+
+def report(requests, registry, posted, elapsed) -> dict:
+    stages = {}
+    for key, h in registry.histograms.get('stage_seconds', {}).items():
+        stage = dict(key)['stage']
+        stages[stage] = dict({'p{}'.format(int(q * 100)): h.quantile(q) for q in QUANTILES},
+                             count=h.count)
+    total = sum(requests.values())
+    return {
+        'posted': posted,
+        'seconds': elapsed,
+        'tweetsPerSecond': posted / elapsed if elapsed else 0,
+        'stages': stages,
+        'requests': requests,
+        'requestsPerTweet': total / posted if posted else None
+    }
+
+
+def printReport(result):
+    print('posted {} tweets in {:.2f}s, {:.1f} tweets/sec'.format(
+        result['posted'], result['seconds'], result['tweetsPerSecond']))
+    print('\n{:<10}{:>10}{:>10}{:>10}{:>8}'.format('stage', 'p50 ms', 'p90 ms', 'p99 ms', 'count'))
+    for stage, s in sorted(result['stages'].items()):
+        print('{:<10}{:>10.1f}{:>10.1f}{:>10.1f}{:>8}'.format(
+            stage, s['p50'] * 1000, s['p90'] * 1000, s['p99'] * 1000, s['count']))
+    posted = result['posted'] or 1
+    print('\n{:<50}{:>8}{:>10}'.format('endpoint', 'count', 'per tweet'))
+    for endpoint, count in sorted(result['requests'].items()):
+        print('{:<50}{:>8}{:>10.2f}'.format(endpoint, count, count / posted))
+    if result['requestsPerTweet'] is not None:
+        print('{:<50}{:>8}{:>10.2f}'.format(
+            'total', sum(result['requests'].values()), result['requestsPerTweet']))
+
+
+def streamCheck(args, stub, app) -> int:
+    '''
+    drive stream.Stream through stub.streamPlan, polling while it is down
+    return: 1 if the stream did not come back or a tweet was missed
+    '''
+    import stream
+    viaStream = set()
+
+    def onTweet(screenName, t):
+        viaStream.add(t.id)
+        app.enqueue(screenName, [t])
+
+    def poll():
+        for key in app.pollKeys():
+            app.pollKey(key)
+
+    # set the since_id cursors
+    stub.publish(1)
+    poll()
+    before = stub.published()
+    queued = app.tweetOutbox.depth()
+
+    tweetStream = stream.Stream(
+        app.tweetClient, onTweet, heartbeat=args.heartbeat, backoff=TICK,
+        rateLimitBackoff=args.heartbeat)
+    stop = threading.Event()
+    thread = tweetStream.start(stop)
+    polls = 0
+    down = 0
+    lastPoll = 0
+    start = time.monotonic()
+    while time.monotonic() - start < args.stream:
+        stub.publish(1)
+        if not tweetStream.connected.is_set():
+            down += TICK
+            if time.monotonic() - lastPoll >= 1:
+                poll()
+                polls += 1
+                lastPoll = time.monotonic()
+        time.sleep(TICK)
+    connected = tweetStream.connected.is_set()
+    stop.set()
+    # what was published while the stream went down at the end
+    poll()
+
+    published = stub.published() - before
+    missed = len(published) + queued - app.tweetOutbox.depth()
+    connections = stub.counts.get(stubs.STREAM, 0)
+    print('{} connections, plan {}, connected at the end {}'.format(
+        connections, list(STREAM_PLAN), connected))
+    print('down {:.1f}s of {:.1f}s, {} polls meanwhile'.format(down, args.stream, polls))
+    print('published {}, via stream {}, via polling {}, missed {}'.format(
+        len(published), len(viaStream & published), len(published - viaStream), missed))
+    failures = []
+    if connections <= len(STREAM_PLAN) or not connected:
+        failures.append('the stream did not come back')
+    if not viaStream:
+        failures.append('no tweet came through the stream')
+    if missed:
+        failures.append('{} tweets missed'.format(missed))
+    stub.shutdown()
+    thread.join(args.heartbeat + 1)
+    if failures:
+        print('\n' + ', '.join(failures))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.WARNING)
+    stub = stubs.Stub(
+        ['bench{}'.format(i) for i in range(args.accounts)],
+        photos=args.photos,
+        photoSize=args.photo_size,
+        latency=args.latency,
+        errorRate=args.error_rate,
+        keepAlive=args.keep_alive,
+        streamPlan=STREAM_PLAN if args.stream else (),
+        dropAfter=args.drop_after).serve()
+    workdir = tempfile.mkdtemp(prefix='retweet-bench-')
+    loadConfig(args, workdir, stub)
+
+    import main as app
+    import metrics
+    import transport
+    logging.getLogger().setLevel(logging.WARNING)
+    app.init()
+    replayer = None
+    if args.replay:
+        replayer = transport.replay(args.replay, speed=args.speed)
+    else:
+        transport.route(stub.routes())
+        if args.record:
+            transport.record(args.record)
+    if args.stream:
+        code = streamCheck(args, stub, app)
+        app.mediaPipeline.shutdown()
+        return code
+
+    # warm up, set the since_id cursors and fetch the tokens
+    stub.publish(1)
+    app.loop()
+    registry = metrics.reset()
+    stub.counts.clear()
+    if replayer:
+        replayer.counts.clear()
+
+    posted = 0
+    start = time.monotonic()
+    for i in range(args.cycles):
+        stub.publish(args.tweets)
+        posted += app.loop()
+    elapsed = time.monotonic() - start
+    app.mediaPipeline.shutdown()
+    stub.shutdown()
+
+    requests = dict(stub.counts)
+    if replayer:
+        requests = {}
+        for key, count in replayer.counts.items():
+            requests[endpoint(key)] = requests.get(endpoint(key), 0) + count
+    result = report(requests, registry, posted, elapsed)
+    printReport(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.max_requests is not None and (result['requestsPerTweet'] or 0) > args.max_requests:
+        print('\nrequests per tweet {:.2f} > {}'.format(result['requestsPerTweet'], args.max_requests))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''cache
+Content-addressed on-disk media cache.
+Blobs are stored by sha256 and read back through mmap, the least recently
+used blobs are evicted once the cache grows over `maxSize`.
+Optionally remembers the weibo pic_id uploaded for a blob.
+'''
+
+import os
+import mmap
+import time
+import hashlib
+import logging
+import threading
+
+import store
+
+MAX_SIZE = 512 * 1024 * 1024  # byte
+PIC_TTL = 24 * 60 * 60  # second
+
+
+def digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class MediaCache(object):
+    """media_url_https -> sha256 -> blob file"""
+
+    def __init__(self, path, maxSize=MAX_SIZE, picTTL=PIC_TTL):
+        super(MediaCache, self).__init__()
+        self.path = path
+        self.blobPath = os.path.join(path, 'blobs')
+        os.makedirs(self.blobPath, exist_ok=True)
+        self.maxSize = maxSize
+        self.picTTL = picTTL
+        self.lock = threading.RLock()
+        # url:<url> -> sha256, pic:<key>:<sha256> -> [pic_id, expires_at]
+        self.index = store.StateFile(os.path.join(path, 'index.json'))
+        self.size = sum(e.stat().st_size for e in os.scandir(self.blobPath))
+
+    def blob(self, h) -> str:
+        return os.path.join(self.blobPath, h)
+
+    def read(self, h):
+        '''
+        return: memoryview over the mmaped blob, None if missing
+        '''
+        path = self.blob(h)
+        try:
+            with open(path, 'rb') as f:
+                os.utime(f.fileno())  # LRU
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+
+    def get(self, url):
+        h = self.index.get('url:' + url)
+        if not h:
+            return None
+        return self.read(h)
+
+    def put(self, url, data) -> str:
+        h = digest(data)
+        path = self.blob(h)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self.size += len(data)
+            self.index.set('url:' + url, h)
+            if self.size > self.maxSize:
+                self.evict()
+        return h
+
+    def fetch(self, url, download):
+        '''
+        return cached data of url, call download(url) on miss
+        a download which raises or returns nothing is not cached
+        '''
+        data = self.get(url)
+        if data is not None:
+            logging.debug('media cache hit - {}'.format(url))
+            return data
+        data = download(url)
+        if not data:
+            return data
+        h = self.put(url, data)
+        return self.read(h) or data
+
+    def evict(self):
+        with self.lock:
+            blobs = sorted(os.scandir(self.blobPath),
+                           key=lambda e: e.stat().st_mtime)
+            removed = set()
+            for e in blobs:
+                if self.size <= self.maxSize:
+                    break
+                size = e.stat().st_size
+                os.remove(e.path)
+                self.size -= size
+                removed.add(e.name)
+            now = time.time()
+            with self.index.lock:
+                for key, value in list(self.index.data.items()):
+                    if key.startswith('url:') and value in removed:
+                        del self.index.data[key]
+                    elif key.startswith('pic:') and value[1] <= now:
+                        del self.index.data[key]
+                self.index.save()
+            logging.debug('media cache evict {} blobs'.format(len(removed)))
+
+    def getPicId(self, h, key=''):
+        value = self.index.get('pic:{}:{}'.format(key, h))
+        if not value or value[1] <= time.time():
+            return None
+        return value[0]
+
+    def setPicId(self, h, picId, key=''):
+        if self.picTTL <= 0:
+            return
+        self.index.set('pic:{}:{}'.format(key, h),
+                       [picId, time.time() + self.picTTL])
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''capture
+Record the HTTP traffic of tweet, weibo and mweibo to a JSONL file and
+replay it later without touching the live APIs, for reproducible load tests.
+Both hook into transport.TimeoutHTTPAdapter, see transport.record() and
+transport.replay().
+Credentials are redacted: Authorization/Cookie headers, access_token/st
+query params and JSON fields. Request bodies are not kept, binary response
+bodies (photos) only by size unless `binary` is set.
+'''
+
+import io
+import json
+import time
+import base64
+import logging
+import threading
+from http.client import responses
+from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
+
+import urllib3
+import requests
+from requests.structures import CaseInsensitiveDict
+
+REDACTED = '[redacted]'
+REDACT_HEADERS = frozenset(['authorization', 'cookie', 'set-cookie', 'proxy-authorization'])
+REDACT_FIELDS = frozenset(['access_token', 'refresh_token', 'st', 'client_secret'])
+# query params which change between runs, left out when matching requests
+VOLATILE_PARAMS = frozenset(['since_id', 'max_id', 'count']) | REDACT_FIELDS
+
+
+def redactUrl(url) -> str:
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    query = [(k, REDACTED if k in REDACT_FIELDS else v) for k, v in parse_qsl(parts.query, True)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def redactHeaders(headers) -> dict:
+    return {k: REDACTED if k.lower() in REDACT_HEADERS else v for k, v in headers.items()}
+
+
+def redactJson(js):
+    if isinstance(js, dict):
+        return {k: REDACTED if k in REDACT_FIELDS else redactJson(v) for k, v in js.items()}
+    if isinstance(js, list):
+        return [redactJson(v) for v in js]
+    return js
+
+
+def requestKey(method, url) -> str:
+    '''
+    method host/path?query without the volatile params
+    '''
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, True) if k not in VOLATILE_PARAMS)
+    return '{} {}{}{}'.format(method, parts.hostname, parts.path, '?' + urlencode(query) if query else '')
+
+
+def setContent(response, content):
+    '''
+    a body already read, close(), iter_content() and iter_lines() work
+    like on a live response
+    '''
+    response._content = content
+    response._content_consumed = True
+    response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(content), headers=dict(response.headers),
+        status=response.status_code, preload_content=False)
+
+
+class Recorder(object):
+    """append one JSON line per request"""
+
+    def __init__(self, path, binary=False):
+        '''
+        binary: keep binary response bodies as base64, else only their size
+        '''
+        super(Recorder, self).__init__()
+        self.path = path
+        self.binary = binary
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def body(self, response) -> dict:
+        content = response.content
+        contentType = response.headers.get('Content-Type', '')
+        if 'json' in contentType or contentType.startswith('text/'):
+            text = content.decode(response.encoding or 'utf-8', 'replace')
+            try:
+                return {'json': redactJson(json.loads(text))}
+            except ValueError:
+                return {'text': text}
+        if self.binary:
+            return {'base64': base64.b64encode(content).decode('ascii')}
+        return {'size': len(content)}
+
+    def record(self, request, response, start, elapsed, stream=False):
+        entry = {
+            't': round(start - self.start, 6),
+            'elapsed': round(elapsed, 6),
+            'method': request.method,
+            'url': redactUrl(request.url),
+            'requestSize': len(request.body or b''),
+            'status': response.status_code,
+            'headers': redactHeaders(response.headers)
+        }
+        if stream:
+            # a stream is read by the caller, its body is not kept
+            entry['stream'] = True
+        else:
+            entry.update(self.body(response))
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Replayer(object):
+    """serve recorded responses by request key, in recorded order"""
+
+    def __init__(self, path, speed=1):
+        '''
+        speed: 1 original timing, 10 ten times faster, 0 no waiting at all
+        '''
+        super(Replayer, self).__init__()
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.last = {}
+        self.counts = {}
+        n = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.queues.setdefault(requestKey(entry['method'], entry['url']), []).append(entry)
+                n += 1
+        for queue in self.queues.values():
+            queue.reverse()  # pop() from the end
+        self.start = time.time()
+        logging.info('replay {} requests from {}'.format(n, path))
+
+    def next(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            queue = self.queues.get(key)
+            if queue:
+                self.last[key] = queue.pop()
+            return self.last.get(key)
+
+    def wait(self, entry):
+        if not self.speed:
+            return
+        # not before it happened in the recording, then as slow as it was
+        delay = self.start + entry['t'] / self.speed - time.time()
+        time.sleep(max(delay, 0) + entry['elapsed'] / self.speed)
+
+    def respond(self, request) -> requests.Response:
+        key = requestKey(request.method, request.url)
+        entry = self.next(key)
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        if entry is None:
+            logging.warning('replay - no recorded response for {}'.format(key))
+            response.status_code = 404
+            response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+            setContent(response, b'{}')
+            return response
+        self.wait(entry)
+        response.status_code = entry['status']
+        response.reason = responses.get(entry['status'], '')
+        headers = CaseInsensitiveDict(entry['headers'])
+        # the body is not compressed any more
+        headers.pop('Content-Encoding', None)
+        if 'json' in entry:
+            content = json.dumps(entry['json']).encode('utf-8')
+        elif 'text' in entry:
+            content = entry['text'].encode('utf-8')
+        elif 'base64' in entry:
+            content = base64.b64decode(entry['base64'])
+        else:
+            content = bytes(entry.get('size', 0))
+        headers['Content-Length'] = str(len(content))
+        response.headers = headers
+        setContent(response, content)
+        return response
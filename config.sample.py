@@ -3,11 +3,103 @@ class Config(object):
     DEBUG = False
     TESTING = False
     # 监控账号 Twitter screen name  *Required
+    # 同时监控多个账号时使用 list，如 ['KanColle_STAFF', 'azurlane_staff']
     SCREEN_NAME = 'KanColle_STAFF'
+    # 列表批量模式，填写包含所有监控账号的 Twitter list id，每次只请求一次列表时间线  *Optional
+    LIST_ID = None
     # Twitter proxy
     PROXY = None
+    # HTTP 超时 (连接超时, 读取超时) second  *Optional
+    HTTP_TIMEOUT = (5, 30)
+    # 每个域名保持的长连接数  *Optional
+    HTTP_POOL_SIZE = 8
+    # 并发下载/上传图片的线程数  *Optional
+    MEDIA_WORKERS = 8
+    # 每个域名的最大并发请求数  *Optional
+    MEDIA_HOST_LIMITS = {'pbs.twimg.com': 4, 'm.weibo.cn': 2}
+    # 图片缓存目录，None 则不缓存  *Optional
+    MEDIA_CACHE = 'cache'
+    # 图片缓存大小上限 byte  *Optional
+    MEDIA_CACHE_SIZE = 512 * 1024 * 1024
+    # 相同图片复用已上传的微博 pic_id 的时间 second，0 则不复用  *Optional
+    PIC_ID_TTL = 24 * 60 * 60
+    # 下载的 pbs.twimg.com 图片尺寸 small/medium/large/4096x4096/orig，None 则使用推特默认尺寸  *Optional
+    PHOTO_VARIANT = None
+    # 上传前在子进程中压缩图片（需要 pip install Pillow），超过像素或大小时缩小/重新编码，无透明的 PNG 转为 JPEG  *Optional
+    RECOMPRESS = False
+    # 压缩后的最大像素数和最大字节数，JPEG 质量  *Optional
+    RECOMPRESS_MAX_PIXELS = 2048 * 2048
+    RECOMPRESS_MAX_BYTES = 2 * 1024 * 1024
+    RECOMPRESS_QUALITY = 85
+    # 压缩图片的进程数，None 则为 CPU 核数  *Optional
+    RECOMPRESS_WORKERS = None
+    # 待发送队列 SQLite 文件，重启后继续发送  *Optional
+    OUTBOX = 'outbox.db'
+    # 发送微博的线程数  *Optional
+    POST_WORKERS = 1
+    # 发送失败的最大重试次数，超过后标记为 dead  *Optional
+    OUTBOX_MAX_ATTEMPTS = 5
+    # 重试间隔 second，每次失败后翻倍  *Optional
+    OUTBOX_BACKOFF = 30
+    # 发送中的微博被占用的时间 second，需长于发送一条的时间，进程退出后超时的微博由其他进程重试  *Optional
+    OUTBOX_LEASE = 600
+    # 跳过已发送过的推特，以及其他帐号发送过的文字或图片相同的推特（多个帐号转发同一条时只发一次）  *Optional
+    DEDUP = True
+    # 已发送记录的保留时间 second  *Optional
+    DEDUP_RETENTION = 30 * 24 * 60 * 60
+    # 文字或图片相同的推特只在此时间内跳过 second，id 相同的推特在 DEDUP_RETENTION 内都跳过  *Optional
+    DEDUP_WINDOW = 6 * 60 * 60
+    # 并发获取推特的线程数  *Optional
+    POLL_WORKERS = 4
+    # 同一台机器上多进程运行时共享的 SQLite 文件（不支持网络文件系统），设置后（或使用 --worker 启动）各进程按一致性哈希分配账号，
+    # 共享 since_id、待发送队列和已发送记录。None 则单进程运行  *Optional
+    SHARD_STORE = None
+    # 进程心跳租约 second，超时未续约的进程的账号会分给其他进程  *Optional
+    SHARD_TTL = 30
+    # 每轮获取/发送的时间预算 second，超出后不再等待图片，只发送文字。None 则不限制  *Optional
+    DEADLINE = 120
+    # 各阶段每个请求的超时 (连接超时, 读取超时) second，不超过剩余的时间预算  *Optional
+    STAGE_TIMEOUTS = {'fetch': (5, 30), 'download': (5, 30), 'upload': (5, 60), 'post': (5, 30)}
+    # 图片下载慢于最近下载耗时的该百分位时，再发送一个请求，取先返回的。None 则不启用  *Optional
+    HEDGE_PERCENTILE = 0.95
+    # 监控指标端口，访问 http://127.0.0.1:<port>/metrics (Prometheus) 或 /metrics.json，None 则不启用  *Optional
+    METRICS_PORT = None
+    # 定期把监控指标写入的 JSON 文件，None 则不写入  *Optional
+    METRICS_FILE = None
+    # 写入 METRICS_FILE 的间隔 second  *Optional
+    METRICS_INTERVAL = 60
+    # 录制所有 HTTP 请求和响应到 JSONL 文件（已去除 token/cookie），None 则不录制  *Optional
+    HTTP_RECORD = None
+    # 回放 HTTP_RECORD 录制的文件，不访问 Twitter/微博，None 则不回放  *Optional
+    HTTP_REPLAY = None
+    # 回放速度，1 为原速，10 为十倍速，0 为不等待  *Optional
+    HTTP_REPLAY_SPEED = 1
     # 监控间隔  *Required
     INTERVAL = 300  # second
+    # 最短监控间隔，账号活跃时按此间隔监控，空闲时逐渐延长到 INTERVAL，并按 Twitter API 剩余次数自动调整  *Optional
+    MIN_INTERVAL = 10  # second
+    # 状态文件，保存每个账号已获取的最新推特id(since_id)，重启后不会重复转发。None 则按 INTERVAL 时间窗口过滤  *Optional
+    STATE_FILE = 'state.json'
+    # 凭据缓存文件，保存 Twitter bearer token 和微博 token，多个进程通过文件锁共享，过期前自动刷新。None 则每次启动重新获取  *Optional
+    CREDENTIALS_FILE = 'credentials.json'
+    # 推送模式，使用 Twitter API v2 filtered stream 实时接收推特，断开时自动回退到轮询  *Optional
+    STREAM = False
+    # 过滤规则  *Optional
+    # include/exclude: 正则表达式 list，包含任意一个才转发/包含任意一个则不转发
+    # photo: True 只转发带图片的推特，False 只转发不带图片的推特
+    # retweet/reply: False 不转发转推/回复，True 只转发转推/回复
+    # lang: 语言 list，如 ['ja']
+    # minLength: 最短文字长度
+    FILTER = {
+        'retweet': None,
+        'reply': None,
+    }
+    # 精简请求，不返回每条推特中的用户信息  *Optional
+    TRIM_USER = True
+    # 排除回复，使用 STATE_FILE 时在本地排除  *Optional
+    EXCLUDE_REPLIES = False
+    # 包含转推  *Optional
+    INCLUDE_RTS = True
 
     # Twitter
     # https://developer.twitter.com/en/docs/basics/authentication/overview/oauth
@@ -33,6 +125,11 @@ class Config(object):
     WEIBO_USERNAME = None
     WEIBO_PASSWORD = None
     WEIBO_FORMAT = '{text}' # 转发微博的格式 *Optional
+    # 同时转发到多个微博帐号，每项为一个 dict：name 以及 WEIBO_COOKIE/WEIBO_ACCESS_TOKEN/WEIBO_USERNAME/WEIBO_PASSWORD 之一  *Optional
+    # WEIBO_APP_ID/WEIBO_APP_SECRET/WEIBO_REDIRECT_URI/WEIBO_FORMAT 未填写时沿用上面的设置
+    # 例如 [{'name': 'main', 'WEIBO_COOKIE': '...'}, {'name': 'backup', 'WEIBO_ACCESS_TOKEN': '...', 'WEIBO_FORMAT': '{text} #retweet#'}]
+    # 不填写时只转发到上面的帐号
+    WEIBO_DESTINATIONS = None
 
     @staticmethod
     def init_app(app):
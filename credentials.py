@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''credentials
+Credential cache on disk, shared by every worker through a file lock.
+Keeps the Twitter bearer token, the weibo OAuth token and the
+m.weibo.cn st token across restarts, refreshed before they expire.
+'''
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import store
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on windows, only lock between threads
+    fcntl = None
+
+REFRESH_MARGIN = 60  # refresh tokens expiring within, second
+
+
+class CredentialStore(object):
+    """key -> {'access_token': ..., 'expires_at': ...}"""
+
+    def __init__(self, path, margin=REFRESH_MARGIN):
+        super(CredentialStore, self).__init__()
+        self.path = path
+        self.margin = margin
+        # tokens, only for the user running the workers
+        self.state = store.StateFile(path, mode=0o600)
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if fcntl is None:
+                self.state.data = self.state.load()
+                yield
+                return
+            with open(self.path + '.lock', 'a+') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    # another worker may have written it
+                    self.state.data = self.state.load()
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def valid(self, value) -> bool:
+        if not value:
+            return False
+        expiresAt = value.get('expires_at')
+        return not expiresAt or expiresAt - self.margin > time.time()
+
+    def get(self, key) -> dict:
+        with self.locked():
+            value = self.state.get(key)
+        return value if self.valid(value) else None
+
+    def set(self, key, value):
+        with self.locked():
+            self.state.set(key, value)
+
+    def fetch(self, key, refresh) -> dict:
+        '''
+        return the stored credential, call refresh() when it is missing or
+        about to expire. Only one worker refreshes at a time.
+        '''
+        with self.locked():
+            value = self.state.get(key)
+            if self.valid(value):
+                return value
+            logging.info('refresh credential - {}'.format(key))
+            value = refresh()
+            self.state.set(key, value)
+            return value
+
+    def invalidate(self, key, value):
+        '''
+        drop a credential rejected by the server, unless another worker
+        already replaced it
+        '''
+        with self.locked():
+            if self.state.get(key) == value:
+                self.state.data.pop(key, None)
+                self.state.save()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''deadline
+Time budget of one cycle (or one tweet), carried through fetch, download,
+upload and post. Inside `with deadline.stage(name)` every request sent
+through the transport session gets the timeout of that stage, cut down to
+what is left of the budget, and fails with DeadlineExceeded once it is spent.
+'''
+
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# (connect, read) timeout per stage, second
+TIMEOUTS = {
+    'fetch': (5, 30),
+    'download': (5, 30),
+    'upload': (5, 60),
+    'post': (5, 30)
+}
+MIN_TIMEOUT = 1  # second, never send a request with less than this
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super(DeadlineExceeded, self).__init__('deadline exceeded - {}'.format(stage))
+        self.stage = stage
+
+
+class Deadline(object):
+    """budget in second, None for no budget"""
+
+    def __init__(self, budget=None, parent=None, timeouts=None):
+        super(Deadline, self).__init__()
+        self.expiresAt = float('inf') if budget is None else time.monotonic() + budget
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        if parent:
+            self.expiresAt = min(self.expiresAt, parent.expiresAt)
+            self.timeouts = dict(parent.timeouts, **(timeouts or {}))
+
+    def remaining(self) -> float:
+        return self.expiresAt - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() < MIN_TIMEOUT
+
+    def reserve(self, seconds):
+        '''
+        return: a deadline ending `seconds` earlier, to keep time for a later stage
+        '''
+        child = Deadline(parent=self)
+        child.expiresAt -= seconds
+        return child
+
+    def timeout(self, stage) -> tuple:
+        '''
+        return: (connect, read) timeout of stage within the remaining budget
+        '''
+        remaining = self.remaining()
+        if remaining < MIN_TIMEOUT:
+            raise DeadlineExceeded(stage)
+        connect, read = self.timeouts.get(stage, TIMEOUTS['fetch'])
+        return min(connect, remaining), min(read, remaining)
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        requests sent by this thread inside the block use the stage timeout
+        '''
+        previous = getattr(_local, 'current', None)
+        _local.current = self, name
+        try:
+            yield self
+        finally:
+            _local.current = previous
+
+
+def timeout():
+    '''
+    return: timeout of the current stage of this thread, None outside a stage
+    '''
+    current = getattr(_local, 'current', None)
+    if current is None:
+        return None
+    d, name = current
+    return d.timeout(name)
+
+
+def stage(d, name):
+    '''
+    d.stage(name), or nothing without a deadline
+    '''
+    return d.stage(name) if d else nullcontext()
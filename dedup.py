@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''dedup
+Index of what has been posted: tweet ids plus fingerprints of the
+normalized text and of the photos, so the same tweet is never posted twice
+and two accounts sharing the same announcement only make one weibo.
+Lookups go through an in-memory Bloom filter first, only a possible hit is
+confirmed in SQLite. Ids match for `retention`, text and photos only match
+a tweet of another account posted within `window`: an account repeating
+its own announcement is posted again. Entries expire after `retention`.
+Processes sharing the SQLite file see each other's entries, see Index.refresh.
+'''
+
+import re
+import math
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+
+RETENTION = 30 * 24 * 60 * 60  # second
+WINDOW = 6 * 60 * 60  # second text and photos match within
+CAPACITY = 100000  # expected entries, the filter grows past it on rebuild
+ERROR_RATE = 0.001
+MIN_TEXT = 20  # shorter texts are too common to be fingerprinted
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posted (
+    fingerprint TEXT PRIMARY KEY,
+    tweet_id TEXT NOT NULL,
+    posted_at REAL NOT NULL,
+    screen_name TEXT
+);
+CREATE INDEX IF NOT EXISTS posted_at ON posted (posted_at);
+'''
+
+URL = re.compile(r'https?://\S+')
+MENTION = re.compile(r'(^|\s)@\w+')
+RT = re.compile(r'^rt\s+@\w+:\s*')
+
+
+def normalize(text) -> str:
+    '''
+    lowercase text without urls (t.co differs per tweet), mentions,
+    punctuation and white space
+    '''
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = RT.sub('', text)
+    text = URL.sub('', text)
+    text = MENTION.sub(' ', text)
+    return ''.join(c for c in text if c.isalnum())
+
+
+def digest(s) -> str:
+    return hashlib.blake2b(s.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def fingerprints(t) -> list:
+    '''
+    t: tweet.TweetRecord
+    return: id:, text: and media: fingerprints of t
+    '''
+    result = ['id:{}'.format(t.id)]
+    text = normalize(t.text)
+    if len(text) >= MIN_TEXT:
+        result.append('text:' + digest(text))
+    if t.photos:
+        # pbs.twimg.com/media/<media id>.jpg is the same for a retweeted photo
+        result.append('media:' + digest(' '.join(sorted(p.rsplit('/', 1)[-1] for p in t.photos))))
+    return result
+
+
+def screenName(t) -> str:
+    return (t.screenName or '').lower()
+
+
+class BloomFilter(object):
+    """fixed size bit array, k hashes from one blake2b by double hashing"""
+
+    def __init__(self, capacity=CAPACITY, errorRate=ERROR_RATE):
+        super(BloomFilter, self).__init__()
+        self.size = max(int(-capacity * math.log(errorRate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        h = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(h[:8], 'little')
+        b = int.from_bytes(h[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class Index(object):
+    """SQLite backed posted index"""
+
+    def __init__(self, path, retention=RETENTION, capacity=CAPACITY, window=WINDOW):
+        super(Index, self).__init__()
+        self.path = path
+        self.retention = retention
+        self.window = window
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+        self.purge()
+
+    def migrate(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(posted)')]
+        if 'screen_name' not in columns:
+            # entries from before count as another account
+            self.conn.execute('ALTER TABLE posted ADD COLUMN screen_name TEXT')
+
+    def rebuild(self):
+        '''
+        a Bloom filter can't forget, build it again from the live entries
+        '''
+        rows = self.conn.execute(
+            'SELECT fingerprint FROM posted WHERE posted_at >= ?',
+            (time.time() - self.retention,)).fetchall()
+        bloom = BloomFilter(max(self.capacity, len(rows) * 2))
+        for row in rows:
+            bloom.add(row[0])
+        self.bloom = bloom
+        self.lastRowid = self.conn.execute('SELECT MAX(rowid) FROM posted').fetchone()[0] or 0
+        logging.debug('dedup - {} fingerprints'.format(len(rows)))
+
+    def refresh(self):
+        '''
+        add what other processes sharing the file posted meanwhile
+        '''
+        rows = self.conn.execute(
+            'SELECT rowid, fingerprint FROM posted WHERE rowid > ?', (self.lastRowid,)).fetchall()
+        for rowid, fingerprint in rows:
+            self.bloom.add(fingerprint)
+            self.lastRowid = max(self.lastRowid, rowid)
+
+    def seen(self, t):
+        '''
+        t: tweet.TweetRecord
+        return: the tweet id posted with the id of t, or with its text or
+        photos by another account within the window, None if new
+        '''
+        keys = fingerprints(t)
+        with self.lock:
+            self.refresh()
+            candidates = [k for k in keys if k in self.bloom]
+            if not candidates:
+                return None
+            ids = [k for k in candidates if k.startswith('id:')]
+            content = [k for k in candidates if not k.startswith('id:')]
+            now = time.time()
+            row = self.conn.execute(
+                'SELECT tweet_id FROM posted WHERE (fingerprint IN ({}) AND posted_at >= ?) '
+                'OR (fingerprint IN ({}) AND posted_at >= ? AND (screen_name IS NULL OR screen_name != ?)) LIMIT 1'.format(
+                    ','.join('?' * len(ids)), ','.join('?' * len(content))),
+                ids + [now - self.retention] + content + [now - self.window, screenName(t)]).fetchone()
+        return row[0] if row else None
+
+    def add(self, t):
+        '''
+        remember t as posted
+        '''
+        now = time.time()
+        keys = fingerprints(t)
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO posted (fingerprint, tweet_id, posted_at, screen_name) VALUES (?, ?, ?, ?)',
+                [(k, str(t.id), now, screenName(t)) for k in keys])
+            for k in keys:
+                self.bloom.add(k)
+
+    def purge(self):
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM posted WHERE posted_at < ?', (time.time() - self.retention,))
+            self.rebuild()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''filters
+Declarative tweet filter, compiled once at startup.
+rules:
+    include: regex list, keep tweets matching any of them
+    exclude: regex list, drop tweets matching any of them
+    photo: True keep only tweets with photo, False only without
+    retweet: True keep only retweets, False drop retweets
+    reply: True keep only replies, False drop replies
+    lang: language list, e.g. ['ja', 'en']
+    minLength: minimum text length
+'''
+
+import re
+import logging
+
+
+def compileRegex(patterns):
+    '''
+    merge the patterns into one alternation
+    '''
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(p) for p in patterns), re.IGNORECASE)
+
+
+class Filter(object):
+    """compiled filter rules over tweet.TweetRecord"""
+
+    def __init__(self, rules=None):
+        super(Filter, self).__init__()
+        rules = rules or {}
+        unknown = set(rules) - {'include', 'exclude', 'photo', 'retweet', 'reply', 'lang', 'minLength'}
+        if unknown:
+            raise Exception('Unknown FILTER rules {}'.format(', '.join(sorted(unknown))))
+        self.checks = []
+        include = compileRegex(rules.get('include'))
+        if include:
+            self.checks.append(lambda t: include.search(t.text) is not None)
+        exclude = compileRegex(rules.get('exclude'))
+        if exclude:
+            self.checks.append(lambda t: exclude.search(t.text) is None)
+        photo = rules.get('photo')
+        if photo is not None:
+            self.checks.append(lambda t: bool(t.photos) == photo)
+        retweet = rules.get('retweet')
+        if retweet is not None:
+            self.checks.append(lambda t: t.isRetweet == retweet)
+        reply = rules.get('reply')
+        if reply is not None:
+            self.checks.append(lambda t: t.isReply == reply)
+        lang = frozenset(rules.get('lang') or ())
+        if lang:
+            self.checks.append(lambda t: t.lang in lang)
+        minLength = rules.get('minLength') or 0
+        if minLength:
+            self.checks.append(lambda t: len(t.text) >= minLength)
+
+    def match(self, t) -> bool:
+        return all(check(t) for check in self.checks)
+
+    def apply(self, l) -> list:
+        '''
+        filter a fetched page at once
+        '''
+        if not self.checks:
+            return list(l)
+        l = list(l)
+        result = [t for t in l if self.match(t)]
+        if len(result) != len(l):
+            logging.debug('filter drop {} tweets'.format(len(l) - len(result)))
+        return result
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+'''imaging
+Shrink photos before they are uploaded to weibo, in a process pool so the
+decoding and encoding never hold up the threads of the poll loop.
+Photos over `maxPixels` are downscaled, PNGs without alpha become JPEGs and
+JPEGs over `maxBytes` are encoded again with a lower quality. Results are
+cached by the sha256 of the source, a photo is never processed twice.
+Needs Pillow (`pip install Pillow`), without it photos are uploaded as is.
+'''
+
+import io
+import math
+import logging
+import threading
+import collections
+import multiprocessing
+import importlib.util
+from posixpath import splitext
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import cache
+
+MAX_PIXELS = 2048 * 2048
+MAX_BYTES = 2 * 1024 * 1024
+QUALITY = 85
+MIN_QUALITY = 60
+MEMORY_CACHE = 64  # results kept in memory without MEDIA_CACHE
+# name= of pbs.twimg.com and the longest side it is scaled down to
+VARIANTS = ((680, 'small'), (1200, 'medium'), (2048, 'large'), (4096, '4096x4096'))
+
+
+def available() -> bool:
+    '''
+    Pillow is installed, without importing it in this process
+    '''
+    return importlib.util.find_spec('PIL') is not None
+
+
+def bestVariant(maxPixels) -> str:
+    '''
+    return: the smallest pbs.twimg.com size still covering maxPixels
+    '''
+    side = math.sqrt(maxPixels)
+    for limit, name in VARIANTS:
+        if limit >= side:
+            return name
+    return 'orig'
+
+
+def variant(url, name) -> str:
+    '''
+    https://pbs.twimg.com/media/<id>.jpg -> https://pbs.twimg.com/media/<id>?format=jpg&name=<name>
+    see: https://developer.twitter.com/en/docs/twitter-api/v1/data-dictionary/object-model/entities#photo_format
+    '''
+    parts = urlsplit(url)
+    if not name or parts.hostname != 'pbs.twimg.com' or not parts.path.startswith('/media/'):
+        return url
+    path, ext = splitext(parts.path)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault('format', ext.lstrip('.') or 'jpg')
+    query['name'] = name
+    return urlunsplit(parts._replace(path=path, query=urlencode(query)))
+
+
+def shrink(data, maxPixels=MAX_PIXELS, maxBytes=MAX_BYTES, quality=QUALITY):
+    '''
+    runs in the pool process
+    return: smaller photo, None to keep data as is
+    '''
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    fmt = image.format
+    if fmt not in ('JPEG', 'PNG'):
+        return None  # GIF, WEBP ...
+    width, height = image.size
+    alpha = image.mode in ('RGBA', 'LA', 'PA') or \
+        (image.mode == 'P' and 'transparency' in image.info)
+    scale = min(1, math.sqrt(maxPixels / (width * height))) if maxPixels else 1
+    toJpeg = fmt == 'PNG' and not alpha
+    if scale >= 1 and not toJpeg and len(data) <= maxBytes:
+        return None
+    if scale < 1:
+        image = image.resize(
+            (max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS)
+    if fmt == 'PNG' and alpha:
+        out = io.BytesIO()
+        image.save(out, 'PNG', optimize=True)
+        result = out.getvalue()
+    else:
+        image = image.convert('RGB')
+        while True:
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            result = out.getvalue()
+            if len(result) <= maxBytes or quality <= MIN_QUALITY:
+                break
+            quality -= 10
+    if scale >= 1 and len(result) >= len(data):
+        return None
+    return result
+
+
+class Recompressor(object):
+    """photo -> smaller photo in a process pool, cached by source hash"""
+
+    def __init__(self, maxPixels=MAX_PIXELS, maxBytes=MAX_BYTES, quality=QUALITY, workers=None,
+                 mediaCache=None):
+        super(Recompressor, self).__init__()
+        self.maxPixels = maxPixels
+        self.maxBytes = maxBytes
+        self.quality = quality
+        self.workers = workers
+        self.cache = mediaCache
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+        # results depend on the settings
+        self.key = 'shrink:{}:{}:{}:'.format(maxPixels, maxBytes, quality)
+
+    def executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                # no fork, the parent has threads holding locks
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def get(self, h):
+        if self.cache:
+            return self.cache.get(self.key + h)
+        with self.lock:
+            if h in self.memory:
+                self.memory.move_to_end(h)
+            return self.memory.get(h)
+
+    def put(self, h, data):
+        if self.cache:
+            self.cache.put(self.key + h, data)
+            return
+        with self.lock:
+            self.memory[h] = data
+            while len(self.memory) > MEMORY_CACHE:
+                self.memory.popitem(last=False)
+
+    def apply(self, data, timeout=None):
+        '''
+        timeout: second, the original is returned when it runs out
+        return: the smaller photo, or data
+        '''
+        h = cache.digest(data)
+        result = self.get(h)
+        if result is not None:
+            # an empty result means keep the original
+            return result if len(result) else data
+        pool = self.executor()
+        try:
+            future = pool.submit(
+                shrink, bytes(data), self.maxPixels, self.maxBytes, self.quality)
+            result = future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            logging.warning('recompress timeout, upload the original')
+            return data
+        except BrokenProcessPool as e:
+            # a child died (OOM ...), the pool is unusable, build a new one next time
+            logging.warning('recompress pool broken, upload the original - {!r}'.format(e))
+            self.reset(pool)
+            return data
+        except Exception as e:
+            # not cached, the next copy of the photo tries again
+            logging.warning('recompress fail, upload the original - {!r}'.format(e))
+            return data
+        # an empty result means keep the original
+        self.put(h, result or b'')
+        if not result:
+            return data
+        logging.debug('recompress {} -> {} bytes'.format(len(data), len(result)))
+        return result
+
+    def reset(self, pool):
+        '''
+        drop a broken pool unless another thread already replaced it
+        '''
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''importcheck
+Cold start budget of the one-shot mode, `python importcheck.py [budget ms]`.
+Imports main with `python -X importtime` in a fresh interpreter, prints the
+slowest modules and exits 1 when the total import time is over budget.
+config.sample.py stands in for the `config` module like in bench.py, so it
+also runs in a checkout without config.py.
+see: https://docs.python.org/3/using/cmdline.html#cmdoption-X
+'''
+
+import os
+import sys
+import subprocess
+
+BUDGET = 300  # millisecond
+TOP = 10
+# config.sample.py as `config`, see bench.loadConfig
+CONFIG = '''
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location('config', 'config.sample.py')
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+sys.modules['config'] = module
+'''
+
+
+def importTime(module='main') -> list:
+    '''
+    return: (cumulative us, depth, module), depth 0 is the top level
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CONFIG + 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if proc.returncode:
+        raise Exception('import {} fail - {}'.format(module, proc.stderr))
+    result = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # header
+        # nested imports are indented by two spaces
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        result.append((int(cumulative), depth, name.strip()))
+    return result
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    result = importTime()
+    total = sum(us for us, depth, _ in result if depth == 0) / 1000
+    # the slowest imports of main and of its own modules
+    direct = [(us, name) for us, depth, name in result if depth == 1]
+    for us, name in sorted(direct, reverse=True)[:TOP]:
+        print('{:>10.1f}ms  {}'.format(us / 1000, name))
+    print('{:>10.1f}ms  total, budget {:.0f}ms'.format(total, budget))
+    return 1 if total > budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,12 +3,23 @@
 import os
 import sys
 import time
+import types
 import datetime
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from config import config
-import weibo
-import mweibo
 import tweet
+import media
+import cache
+import outbox
+import dedup
+import filters
+import transport
+import credentials
+import deadline
+import metrics
+from urllib.parse import urlsplit
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - [%(levelname)s] %(message)s",
@@ -23,152 +34,677 @@ if sys.version_info[0] < 3:
 if config.DEBUG:
     logging.getLogger('root').setLevel(logging.DEBUG)
     logger.setLevel(logging.DEBUG)
-logger.info('Loaded config: {}'.format(str(config)))
 
+# exit status of the one-shot mode
+EXIT_POSTED = 0
+EXIT_ERROR = 1
+EXIT_IDLE = 2
 
-weiboClient = None
+# name of the single weibo account without WEIBO_DESTINATIONS
+DEFAULT_DESTINATION = 'weibo'
+# per destination settings, the others are taken from config when missing
+DESTINATION_KEYS = ('WEIBO_COOKIE', 'WEIBO_ACCESS_TOKEN', 'WEIBO_USERNAME', 'WEIBO_PASSWORD')
+SHARED_KEYS = ('WEIBO_APP_ID', 'WEIBO_APP_SECRET', 'WEIBO_REDIRECT_URI', 'WEIBO_FORMAT')
+
+
+weiboDestinations = []
 tweetClient = None
+mediaPipeline = None
+postExecutor = None
+photoVariant = None
+tweetOutbox = None
+postedIndex = None
+tweetFilter = None
+workerShard = None
+
+
+class Destination(object):
+    """one weibo account with its own client and WEIBO_FORMAT"""
+
+    def __init__(self, name, settings, credentialStore=None):
+        super(Destination, self).__init__()
+        self.name = name
+        self.client = getWeiboClient(settings, credentialStore)
+        self.format = settings.WEIBO_FORMAT
+        self.redirectUri = settings.WEIBO_REDIRECT_URI
+        # pic_id belongs to the account which uploaded it
+        self.uploadKey = 'mweibo' if name == DEFAULT_DESTINATION else 'mweibo:' + name
 
 
-def getWeiboClient(config):
+def getCredentials(config):
+    path = getattr(config, 'CREDENTIALS_FILE', None)
+    return credentials.CredentialStore(path) if path else None
+
+
+def getWeiboClient(config, credentialStore=None):
+    # only import the selected backend
     if config.WEIBO_COOKIE:
         logger.debug('weiboClient use WEIBO_COOKIE')
         # weibo H5
-        weiboClient = mweibo.WeiboAPI(config.WEIBO_COOKIE)
+        import mweibo
+        weiboClient = mweibo.WeiboAPI(config.WEIBO_COOKIE, credentials=credentialStore)
     elif config.WEIBO_ACCESS_TOKEN:
         # weibo API
         logger.debug('weiboClient use WEIBO_ACCESS_TOKEN')
+        import weibo
         weiboClient = weibo.Client(config.WEIBO_APP_ID, config.WEIBO_APP_SECRET, config.WEIBO_REDIRECT_URI, token={
-            'access_token': config.WEIBO_ACCESS_TOKEN})
+            'access_token': config.WEIBO_ACCESS_TOKEN}, credentials=credentialStore)
     elif config.WEIBO_USERNAME and config.WEIBO_PASSWORD:
         # weibo API + username/password
         logger.debug('weiboClient use WEIBO_USERNAME ans WEIBO_PASSWORD')
+        import weibo
         weiboClient = weibo.Client(config.WEIBO_APP_ID, config.WEIBO_APP_SECRET, config.WEIBO_REDIRECT_URI,
-                                   username=config.WEIBO_USERNAME, password=config.WEIBO_PASSWORD)
+                                   username=config.WEIBO_USERNAME, password=config.WEIBO_PASSWORD,
+                                   credentials=credentialStore)
     else:
         raise Exception(
             'Get weiboClient fail - WEIBO_COOKIE not found OR WEIBO_ACCESS_TOKEN not found OR (WEIBO_USERNAME and config.WEIBO_PASSWORD) not found')
     return weiboClient
 
 
-def getTweetClient(config):
+def getDestinations(config, credentialStore=None) -> list:
+    '''
+    WEIBO_DESTINATIONS, or the single account of WEIBO_COOKIE/WEIBO_ACCESS_TOKEN/...
+    '''
+    destinations = getattr(config, 'WEIBO_DESTINATIONS', None)
+    if not destinations:
+        return [Destination(DEFAULT_DESTINATION, config, credentialStore)]
+    result = []
+    for i, d in enumerate(destinations):
+        settings = {key: getattr(config, key, None) for key in SHARED_KEYS}
+        settings.update({key: None for key in DESTINATION_KEYS})
+        settings.update(d)
+        name = settings.pop('name', None) or 'weibo{}'.format(i)
+        if name in [r.name for r in result]:
+            raise Exception('Duplicate WEIBO_DESTINATIONS name {}'.format(name))
+        result.append(Destination(name, types.SimpleNamespace(**settings), credentialStore))
+    return result
+
+
+def getShardStore(config):
+    '''
+    worker mode with --worker or SHARD_STORE, several processes split the
+    accounts and share cursors, outbox and dedup index through the store
+    return: shard.Store, None without worker mode
+    '''
+    path = getattr(config, 'SHARD_STORE', None)
+    if not path and '--worker' not in sys.argv:
+        return None
+    import shard
+    return shard.SQLiteStore(path or 'shard.db')
+
+
+def getTweetClient(config, credentialStore=None, state=None):
     payload = {
         'apiKey': config.TWITTER_API_KEY,
         'apiSecret': config.TWITTER_API_SECRET,
         'bearerToken': config.TWITTER_BEARER_TOKEN,
         'proxy': config.PROXY,
         'screenName': config.SCREEN_NAME,
-        'interval': config.INTERVAL
+        'interval': config.INTERVAL,
+        'stateFile': getattr(config, 'STATE_FILE', None),
+        'listId': getattr(config, 'LIST_ID', None),
+        'trimUser': getattr(config, 'TRIM_USER', True),
+        'excludeReplies': getattr(config, 'EXCLUDE_REPLIES', False),
+        'includeRts': getattr(config, 'INCLUDE_RTS', True),
+        'credentials': credentialStore,
+        'state': state
     }
     tweetClient = tweet.Tweet(**payload)
     return tweetClient
 
 
 def init():
-    global weiboClient, tweetClient, config
-    weiboClient = getWeiboClient(config)
-    tweetClient = getTweetClient(config)
-    logger.info('Monitoring {}'.format(tweetClient.screenName))
+    global weiboDestinations, tweetClient, mediaPipeline, postExecutor, photoVariant, tweetOutbox, postedIndex, tweetFilter, workerShard, config
+    transport.configure(
+        timeout=getattr(config, 'HTTP_TIMEOUT', transport.TIMEOUT),
+        poolSize=getattr(config, 'HTTP_POOL_SIZE', transport.POOL_MAXSIZE))
+    if getattr(config, 'HTTP_REPLAY', None):
+        transport.replay(config.HTTP_REPLAY, speed=getattr(config, 'HTTP_REPLAY_SPEED', 1))
+    elif getattr(config, 'HTTP_RECORD', None):
+        transport.record(config.HTTP_RECORD)
+    credentialStore = getCredentials(config)
+    weiboDestinations = getDestinations(config, credentialStore)
+    shardStore = getShardStore(config)
+    tweetClient = getTweetClient(config, credentialStore, state=shardStore)
+    mediaCache = None
+    if getattr(config, 'MEDIA_CACHE', None):
+        mediaCache = cache.MediaCache(
+            config.MEDIA_CACHE,
+            maxSize=getattr(config, 'MEDIA_CACHE_SIZE', cache.MAX_SIZE),
+            picTTL=getattr(config, 'PIC_ID_TTL', cache.PIC_TTL))
+    recompressor = None
+    photoVariant = getattr(config, 'PHOTO_VARIANT', None)
+    if getattr(config, 'RECOMPRESS', False):
+        import imaging
+        if imaging.available():
+            maxPixels = getattr(config, 'RECOMPRESS_MAX_PIXELS', imaging.MAX_PIXELS)
+            recompressor = imaging.Recompressor(
+                maxPixels=maxPixels,
+                maxBytes=getattr(config, 'RECOMPRESS_MAX_BYTES', imaging.MAX_BYTES),
+                quality=getattr(config, 'RECOMPRESS_QUALITY', imaging.QUALITY),
+                workers=getattr(config, 'RECOMPRESS_WORKERS', None),
+                mediaCache=mediaCache)
+            # no need to download more pixels than kept
+            photoVariant = photoVariant or imaging.bestVariant(maxPixels)
+        else:
+            logger.warning('RECOMPRESS needs Pillow (pip install Pillow), photos are uploaded as is')
+    mediaPipeline = media.Pipeline(
+        workers=getattr(config, 'MEDIA_WORKERS', media.WORKERS),
+        hostLimits=getattr(config, 'MEDIA_HOST_LIMITS', None),
+        mediaCache=mediaCache,
+        hedgePercentile=getattr(config, 'HEDGE_PERCENTILE', None),
+        recompressor=recompressor)
+    postExecutor = None
+    if len(weiboDestinations) > 1:
+        postExecutor = ThreadPoolExecutor(
+            max_workers=len(weiboDestinations), thread_name_prefix='post')
+    tweetFilter = filters.Filter(getattr(config, 'FILTER', None))
+    outboxSettings = {
+        'maxAttempts': getattr(config, 'OUTBOX_MAX_ATTEMPTS', outbox.MAX_ATTEMPTS),
+        'backoff': getattr(config, 'OUTBOX_BACKOFF', outbox.BACKOFF),
+        'lease': getattr(config, 'OUTBOX_LEASE', outbox.LEASE)
+    }
+    indexSettings = {
+        'retention': getattr(config, 'DEDUP_RETENTION', dedup.RETENTION),
+        'window': getattr(config, 'DEDUP_WINDOW', dedup.WINDOW)
+    }
+    postedIndex = None
+    if shardStore:
+        # the workers share one outbox and dedup index through the store
+        tweetOutbox = shardStore.openOutbox(**outboxSettings)
+        if getattr(config, 'DEDUP', True):
+            postedIndex = shardStore.openIndex(**indexSettings)
+    else:
+        outboxPath = getattr(config, 'OUTBOX', 'outbox.db')
+        tweetOutbox = outbox.Outbox(outboxPath, **outboxSettings)
+        if getattr(config, 'DEDUP', True):
+            # next to the outbox, in the same SQLite file
+            postedIndex = dedup.Index(outboxPath, **indexSettings)
+    workerShard = None
+    if shardStore:
+        import shard
+        workerShard = shard.Shard(shardStore, ttl=getattr(config, 'SHARD_TTL', shard.TTL))
+        workerShard.heartbeat()
+        logger.info('worker {}'.format(workerShard.workerId))
+    initMetrics()
+    logger.info('Monitoring {}'.format(', '.join(tweetClient.screenNames)))
+
+
+def initMetrics():
+    '''
+    gauges read on every scrape
+    '''
+    def oldestAge():
+        oldest = tweetOutbox.oldest()
+        return time.time() - oldest if oldest else 0
+    metrics.describe('stage_seconds', 'latency of fetch, decode, download, recompress, upload and post')
+    metrics.describe('posts_total', 'posts per weibo destination')
+    metrics.describe('tweets_duplicate_total', 'tweets skipped as already posted')
+    metrics.describe('fetch_errors_total', 'failed timeline fetches per account')
+    metrics.gauge('rate_limit_remaining',
+                  lambda: {key: r['remaining'] for key, r in dict(tweetClient.rateLimits).items()},
+                  label='account')
+    metrics.gauge('outbox_depth', tweetOutbox.depth)
+    metrics.gauge('outbox_oldest_age_seconds', oldestAge)
 
 
 def filterTweet(l) -> list:
-    # filter photo
-    # l = filter(tweet.hasImage, l)  # tweet contains photo
-    l = list(l)
-    return l
+    '''
+    drop tweets rejected by FILTER before any photo download
+    '''
+    return tweetFilter.apply(l)
 
 
-def formatTweet(t) -> (str, list):
+def formatTweet(t, weiboFormat=None) -> (str, list):
     '''
-    return: tweet.full_text, extended_entities.photo
+    t: tweet.TweetRecord
+    weiboFormat: WEIBO_FORMAT of the destination
+    return: formatted text, photo urls
     '''
-    text = t.get('full_text')
-    media = t.get('extended_entities', {}).get('media', {})
-    media = filter(lambda media: media.get('type') == 'photo', media)
-    photoList = map(lambda media: media.get('media_url_https'), media)
-    pics = list(map(lambda link: tweet.getPhoto(
-        link, proxy=config.PROXY), photoList))
+    weiboFormat = weiboFormat or config.WEIBO_FORMAT
+    text = t.text
+    photoList = list(t.photos)
 
     tz_utc_8 = datetime.timezone(datetime.timedelta(hours=8))
-    tweetTime = datetime.datetime.strptime(
-        t.get('created_at'), '%a %b %d %H:%M:%S %z %Y')
-    tweetTime = tweetTime.astimezone(tz_utc_8)  # change timezone
+    tweetTime = datetime.datetime.fromtimestamp(t.createdAt, tz_utc_8)
     timeStr = tweetTime.strftime('%Y.%m.%d %H:%M:%S')
 
     def formatter(str):
         # format weibo
-        return config.WEIBO_FORMAT.format(text=str, time=timeStr)
+        return weiboFormat.format(text=str, time=timeStr)
     status = formatter(text)
 
     # word count limit
     if len(status) > 140:
-        logger.debug('input text more than 140 characters ' + str(len(text)))
+        logger.debug('input text more than 140 characters %s', len(text))
         text = text[0:(140 - len(status) - 3)] + '...'
         status = formatter(text)
-    return status, pics
+    return status, photoList
 
 
-def postWeibo(text, pics):
+def getDeadline(parent=None) -> deadline.Deadline:
+    '''
+    budget of one cycle, DEADLINE second
+    '''
+    return deadline.Deadline(
+        getattr(config, 'DEADLINE', None),
+        parent=parent,
+        timeouts=getattr(config, 'STAGE_TIMEOUTS', None))
+
+
+def getPics(photoList, budget=None, destinations=None) -> dict:
+    '''
+    download photos concurrently, once for all destinations
+    weibo H5 uploads each photo right after its download and gets pic_id
+    budget: deadline.Deadline
+    return: {destination name: photo data or pic_id, same order as photoList},
+    or the exception of a destination whose upload failed
+    '''
+    destinations = destinations or weiboDestinations
+    if not photoList:
+        return {d.name: [] for d in destinations}
+    uploads = {}
+    for d in destinations:
+        client = d.client
+        # the backend module is imported lazily, tell them apart by method
+        if hasattr(client, 'shareWeibo'):
+            # weibo API only takes one photo, keep the data
+            uploads[d.name] = None
+        elif hasattr(client, 'upload_image'):
+            uploads[d.name] = (
+                lambda data, client=client: client.upload_image(data).get('pic_id'),
+                urlsplit(client.upload_path).hostname,
+                d.uploadKey)
+        else:
+            raise Exception('unknown weiboClient!')
+    if not any(uploads.values()):
+        photoList = photoList[:1]
+    if photoVariant:
+        import imaging
+        photoList = [imaging.variant(url, photoVariant) for url in photoList]
+    pics = mediaPipeline.fanout(photoList, uploads, deadline=budget)
+    for name, options in uploads.items():
+        if options is None:
+            pics[name] = pics[name][:1]
+    return pics
+
+
+def postWeibo(text, pics, destination=None):
     '''
     param
     text: str
-    pics: list
+    pics: list, photo data or weibo H5 pic_id
+    destination: Destination, the first one by default
     '''
-    if isinstance(weiboClient, weibo.Client):
+    destination = destination or weiboDestinations[0]
+    weiboClient = destination.client
+    if hasattr(weiboClient, 'shareWeibo'):
         # weibo API
         if not len(pics):
-            resp = weiboClient.shareWeibo(text, redirect_uri=config.WEIBO_REDIRECT_URI)
+            resp = weiboClient.shareWeibo(text, redirect_uri=destination.redirectUri)
             return resp
         if len(pics) > 1:
             logging.warn('tweet 图片数量超过一张，已自动过滤为一张')
         pic = pics[0]
         resp = weiboClient.shareWeibo(
-            text, pic=pic, redirect_uri=config.WEIBO_REDIRECT_URI)
+            text, pic=pic, redirect_uri=destination.redirectUri)
         return resp
-    if isinstance(weiboClient, mweibo.WeiboAPI):
+    if hasattr(weiboClient, 'upload_image'):
         # weibo H5
         resp = weiboClient.post(text, pic=pics)
         return resp
     raise Exception('unknown weiboClient!')
 
 
-def loop():
-    l = tweetClient.getNewTweets()
+def isDuplicate(t, stage) -> bool:
+    '''
+    t: tweet.TweetRecord
+    stage: where it was checked, enqueue or post
+    return: True if t, or the same text or photos of another account, was already posted
+    '''
+    if postedIndex is None:
+        return False
+    postedId = postedIndex.seen(t)
+    if postedId is None:
+        return False
+    logger.info('already posted as {}, skip - {}'.format(postedId, t.id))
+    metrics.inc('tweets_duplicate_total', stage=stage)
+    return True
 
+
+def enqueue(screenName, l) -> int:
+    '''
+    put new tweets of one account into the outbox
+    return: number of queued tweets
+    '''
     for t in l:
         url = 'https://twitter.com/{}/status/{}'.format(
-            tweetClient.screenName, t.get('id'))
+            screenName, t.id)
         logger.info('new tweet - {}'.format(url))
+    metrics.inc('tweets_seen_total', len(l), account=screenName)
 
+    seen = len(l)
     l = filterTweet(l)
-    if len(l) <= 0:
-        return
-
+    metrics.inc('tweets_filtered_total', seen - len(l), account=screenName)
+    l = [t for t in l if not isDuplicate(t, 'enqueue')]
+    n = 0
     for t in l:
-        text, pics = formatTweet(t)
-        logger.info('post weibo... - {}'.format(text))
-        resp = postWeibo(text, pics)
-        logger.debug('postWeibo resp - ' + str(resp))
+        if tweetOutbox.put(t.id, t.toDict()):
+            n += 1
+    return n
+
+
+def poll(interval=None, screenName=None) -> int:
+    '''
+    fetch new tweets of one account into the outbox
+    interval: time window without STATE_FILE, second
+    return: number of queued tweets
+    '''
+    screenName = screenName or tweetClient.screenName
+    l, cursor = tweetClient.getNewTweets(interval=interval, screenName=screenName)
+    n = enqueue(screenName, l)
+    # only once the tweets are durable, a failure above fetches them again
+    tweetClient.commitCursor(cursor)
+    return n
+
+
+def pollList(interval=None) -> int:
+    '''
+    list batch mode, fetch new tweets of every account with one request
+    '''
+    groups, cursor = tweetClient.getListTweets(interval=interval)
+    n = sum(enqueue(screenName, l) for screenName, l in groups.items())
+    tweetClient.commitCursor(cursor)
+    return n
+
+
+def pollKeys() -> list:
+    '''
+    return: screen names, or list:<LIST_ID> in list batch mode
+    '''
+    if tweetClient.listId:
+        return ['list:{}'.format(tweetClient.listId)]
+    return tweetClient.screenNames
+
+
+def pollKey(key, interval=None, budget=None) -> int:
+    '''
+    budget: deadline.Deadline, DEADLINE by default
+    '''
+    with (budget or getDeadline()).stage('fetch'):
+        if key.startswith('list:'):
+            return pollList(interval=interval)
+        return poll(interval=interval, screenName=key)
+
+
+def pollAll(executor, interval=None, budget=None) -> (int, int):
+    '''
+    poll every account concurrently, errors are isolated per account
+    return: number of queued tweets, number of accounts whose fetch failed
+    '''
+    def task(key):
+        try:
+            return pollKey(key, interval=interval, budget=budget), 0
+        except Exception as e:
+            logger.exception('{} - {}'.format(key, e))
+            metrics.inc('fetch_errors_total', account=key)
+            return 0, 1
+    keys = pollKeys()
+    if workerShard:
+        keys = [key for key in keys if workerShard.owns(key)]
+    results = list(executor.map(task, keys))
+    return sum(n for n, _ in results), sum(e for _, e in results)
+
+
+def process(t, budget=None, destinations=None) -> dict:
+    '''
+    post to every destination, concurrently when there are more than one
+    budget: deadline.Deadline of the cycle, photos are dropped when it runs out
+    return: {destination name: exception} of the failed destinations
+    '''
+    budget = getDeadline(parent=budget)
+    destinations = destinations or weiboDestinations
+    photoList = list(t.photos)
+    # keep time for the post itself
+    mediaBudget = budget.reserve(min(budget.timeouts['post'][1], budget.remaining() / 2))
+    try:
+        pics = getPics(photoList, mediaBudget, destinations)
+    except Exception as e:
+        if not mediaBudget.expired():
+            raise
+        logger.warning('photos timeout, post without photos - {} {!r}'.format(t.id, e))
+        metrics.inc('photos_dropped_total', len(photoList))
+        pics = {d.name: [] for d in destinations}
+
+    def post(d):
+        text, _ = formatTweet(t, d.format)
+        dpics = pics[d.name]
+        if isinstance(dpics, Exception):
+            if not mediaBudget.expired():
+                raise dpics
+            logger.warning('photos timeout, post without photos - {} {} {!r}'.format(d.name, t.id, dpics))
+            metrics.inc('photos_dropped_total', len(photoList))
+            dpics = []
+        logger.info('post weibo... - {} {}'.format(d.name, text))
+        with budget.stage('post'), metrics.timer('stage_seconds', stage='post'):
+            resp = postWeibo(text, dpics, d)
+        logger.debug('postWeibo resp - %s', resp)
+        return resp
+
+    errors = {}
+    if postExecutor is None or len(destinations) == 1:
+        for d in destinations:
+            try:
+                post(d)
+            except Exception as e:
+                errors[d.name] = e
+        return errors
+    futures = {d.name: postExecutor.submit(post, d) for d in destinations}
+    for name, f in futures.items():
+        try:
+            f.result()
+        except Exception as e:
+            errors[name] = e
+    return errors
+
+
+def drain(budget=None, limit=None) -> int:
+    '''
+    post every ready tweet in the outbox
+    a retried tweet only goes to the destinations which have not got it yet
+    budget: deadline.Deadline, stop claiming once it runs out
+    limit: claim at most this many tweets
+    return: number of posted tweets
+    '''
+    n = 0
+    claimed = 0
+    while not (budget and budget.expired()):
+        if limit is not None and claimed >= limit:
+            return n
+        claimed += 1
+        item = tweetOutbox.claim()
+        if not item:
+            return n
+        id, payload = item
+        t = tweet.TweetRecord.fromDict(payload)
+        # another account may have posted the same meanwhile
+        if isDuplicate(t, 'post'):
+            tweetOutbox.done(id)
+            continue
+        delivered = tweetOutbox.delivered(id)
+        targets = [d for d in weiboDestinations
+                   if delivered.get(d.name, {}).get('state') != outbox.DONE]
+        try:
+            errors = process(t, budget, targets)
+        except Exception as e:
+            logger.exception('post weibo fail - {}'.format(t.id))
+            errors = {d.name: e for d in targets}
+        for d in targets:
+            error = errors.get(d.name)
+            tweetOutbox.deliver(id, d.name, repr(error) if error else None)
+            metrics.inc('posts_total', destination=d.name, result='error' if error else 'ok')
+        if errors:
+            state = tweetOutbox.fail(id, '; '.join(
+                '{}: {!r}'.format(name, e) for name, e in sorted(errors.items())))
+            for name, e in sorted(errors.items()):
+                logger.error('post weibo fail, {} - {} {}'.format(state, name, t.id), exc_info=e)
+            metrics.inc('tweets_failed_total', state=state)
+            continue
+        if postedIndex:
+            postedIndex.add(t)
+        tweetOutbox.done(id)
+        metrics.inc('tweets_posted_total')
+        n += 1
+    logger.warning('deadline exceeded, {} tweets left in outbox'.format(tweetOutbox.depth()))
+    return n
+
+
+def cycle() -> (int, int):
+    '''
+    one fetch/post cycle within DEADLINE
+    return: number of posted tweets, number of accounts whose fetch failed
+    '''
+    budget = getDeadline()
+    with ThreadPoolExecutor(max_workers=getattr(config, 'POLL_WORKERS', 4)) as executor:
+        _, errors = pollAll(executor, budget=budget)
+    return drain(budget), errors
+
+
+def loop() -> int:
+    '''
+    one fetch/post cycle within DEADLINE
+    return: number of posted tweets
+    '''
+    return cycle()[0]
+
+
+def once() -> int:
+    '''
+    one-shot mode for cron, run one cycle and exit
+    return: EXIT_ERROR if a fetch failed or posts are left to retry,
+    else EXIT_POSTED or EXIT_IDLE
+    '''
+    n, errors = cycle()
+    pending = tweetOutbox.depth()
+    if getattr(config, 'METRICS_FILE', None):
+        metrics.getRegistry().dump(config.METRICS_FILE)
+    mediaPipeline.shutdown()
+    if workerShard:
+        workerShard.leave()
+    tweetOutbox.close()
+    if postedIndex:
+        postedIndex.close()
+    logger.info('posted {}, pending {}, fetch errors {}'.format(n, pending, errors))
+    if errors:
+        return EXIT_ERROR
+    if n:
+        return EXIT_POSTED
+    return EXIT_ERROR if pending else EXIT_IDLE
+
+
+def worker(stop):
+    while not stop.is_set():
+        if not drain():
+            stop.wait(1)
+
+
+def pollAccount(pollScheduler, key, lastPoll):
+    '''
+    poll one account (or the list) and schedule its next poll
+    '''
+    now = time.time()
+    try:
+        # without STATE_FILE, only take tweets since the last poll
+        n = pollKey(key, interval=now - lastPoll.get(key, now - config.INTERVAL))
+        lastPoll[key] = now
+        pollScheduler.next(key, n > 0, tweetClient.rateLimit)
+    except tweet.RateLimitError as e:
+        pollScheduler.limited(key, e.reset)
+    except Exception as e:
+        logger.exception('{} - {}'.format(key, e))
+        metrics.inc('fetch_errors_total', account=key)
+        pollScheduler.next(key, False, tweetClient.rateLimit)
 
 
 def main():
+    logger.info('Loaded config: {}'.format(str(config)))
     init()
 
-    if '-f' in sys.argv:  # debug argv
-        loop()
-    if config.INTERVAL < 30:
-        logger.warn('sleep time is too short! sleepTime: {}s. Forced to change to 30s'.format(
-            config.INTERVAL))
-        config.INTERVAL = 30
+    if '-f' in sys.argv or '--once' in sys.argv:
+        return once()
+    return daemon()
 
-    while True:
-        logger.debug('sleep {}s...'.format(config.INTERVAL))
-        time.sleep(config.INTERVAL)
-        loop()
+
+def daemon(stop=None):
+    '''
+    long running mode after init(): post workers, stream and the poll scheduler
+    stop: threading.Event, runs until it is set, forever by default
+    '''
+    import scheduler
+
+    if getattr(config, 'METRICS_PORT', None):
+        metrics.serve(config.METRICS_PORT)
+
+    stop = stop or threading.Event()
+    for i in range(getattr(config, 'POST_WORKERS', 1)):
+        threading.Thread(target=worker, args=(stop,),
+                         name='worker-{}'.format(i), daemon=True).start()
+
+    if workerShard:
+        workerShard.start(stop)
+
+    tweetStream = None
+    if getattr(config, 'STREAM', False) and getattr(config, 'HTTP_REPLAY', None):
+        # the body of a stream is not recorded, replay polls only
+        logger.info('HTTP_REPLAY - stream disabled, polling only')
+    elif getattr(config, 'STREAM', False):
+        import stream
+        tweetStream = stream.Stream(
+            tweetClient, lambda screenName, t: enqueue(screenName, [t]))
+        tweetStream.start(stop)
+
+    pollScheduler = scheduler.Scheduler(
+        pollKeys(),
+        minInterval=getattr(config, 'MIN_INTERVAL', scheduler.MIN_INTERVAL),
+        maxInterval=config.INTERVAL)
+    executor = ThreadPoolExecutor(
+        max_workers=getattr(config, 'POLL_WORKERS', 4), thread_name_prefix='poll')
+    lastPoll = {}
+    lastPurge = time.time()
+    lastDump = time.time()
+    try:
+        while not stop.is_set():
+            # polling is the fallback while the stream is down
+            if not (tweetStream and tweetStream.connected.is_set()):
+                for key in pollScheduler.ready():
+                    if workerShard and not workerShard.owns(key):
+                        # polled by another worker, look again after the next heartbeat
+                        pollScheduler.defer(key, workerShard.ttl / 3)
+                        continue
+                    executor.submit(pollAccount, pollScheduler, key, lastPoll)
+            if time.time() - lastPurge > config.INTERVAL:
+                # posts of a worker which died since
+                tweetOutbox.recover()
+                tweetOutbox.purge()
+                if postedIndex:
+                    postedIndex.purge()
+                lastPurge = time.time()
+            if getattr(config, 'METRICS_FILE', None) and \
+                    time.time() - lastDump > getattr(config, 'METRICS_INTERVAL', 60):
+                metrics.getRegistry().dump(config.METRICS_FILE)
+                lastDump = time.time()
+            time.sleep(min(pollScheduler.wait(), 1))
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+        if workerShard:
+            workerShard.leave()
 
 
 if __name__ == '__main__':
     try:
-        main()
+        sys.exit(main())
     except Exception as e:
         logger.exception(e)
+        sys.exit(EXIT_ERROR)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''media
+Download (and upload) the photos of a tweet concurrently.
+Every photo is downloaded once and uploaded to each destination as soon
+as its own download finishes, results keep the order of the input urls.
+A download slower than the `hedgePercentile` of recent downloads gets a
+second (hedged) request, the first response wins. With a `recompressor`
+(imaging.Recompressor) photos are shrunk once, right after the download.
+see: https://research.google/pubs/the-tail-at-scale/
+'''
+
+import time
+import logging
+import threading
+import collections
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+
+import cache
+import tweet
+import metrics
+from deadline import stage
+
+WORKERS = 8
+# max concurrent requests per host
+HOST_LIMITS = {
+    'pbs.twimg.com': 4,
+    'm.weibo.cn': 2
+}
+DEFAULT_HOST_LIMIT = 4
+LATENCY_SAMPLES = 200  # recent downloads kept for the percentile
+HEDGE_MIN_SAMPLES = 20  # no hedging before
+
+
+class Pipeline(object):
+    """bounded download -> upload pipeline"""
+
+    def __init__(self, workers=WORKERS, hostLimits=None, defaultLimit=DEFAULT_HOST_LIMIT, mediaCache=None,
+                 hedgePercentile=None, recompressor=None):
+        '''
+        hedgePercentile: e.g. 0.95, None to disable hedged downloads
+        recompressor: imaging.Recompressor, None to upload the photos as downloaded
+        '''
+        super(Pipeline, self).__init__()
+        self.cache = mediaCache
+        self.recompressor = recompressor
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='media')
+        self.hostLimits = dict(HOST_LIMITS, **(hostLimits or {}))
+        self.defaultLimit = defaultLimit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        self.hedgePercentile = hedgePercentile
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.hedger = None
+        if hedgePercentile:
+            # the first request and its hedge, apart from the pipeline workers
+            self.hedger = ThreadPoolExecutor(
+                max_workers=workers * 2, thread_name_prefix='hedge')
+
+    def limit(self, host) -> threading.Semaphore:
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.hostLimits.get(host, self.defaultLimit))
+            return self.semaphores[host]
+
+    def run(self, urls, upload=None, uploadHost=None, uploadKey=None, deadline=None) -> list:
+        '''
+        urls: photo urls
+        upload: data -> pic_id, called right after each download
+        uploadHost: host used by upload, for the concurrency limit
+        uploadKey: remember pic_id by content hash under this key, needs cache
+        deadline: deadline.Deadline of the downloads and uploads
+        return: downloaded data (or pic_id) in the order of urls
+        '''
+        uploads = {None: (upload, uploadHost, uploadKey) if upload else None}
+        result = self.fanout(urls, uploads, deadline)[None]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fanout(self, urls, uploads, deadline=None) -> dict:
+        '''
+        download every url once and upload it to every destination as soon
+        as it arrives
+        uploads: {destination: (upload, uploadHost, uploadKey)}, None keeps the data
+        return: {destination: data (or pic_id) in the order of urls}, or the
+        exception of a failed upload for that destination
+        raise: a failed download, it fails every destination
+        '''
+        downloads = {self.executor.submit(self.fetch, url, deadline): i
+                     for i, url in enumerate(urls)}
+        results = {name: [None] * len(urls) for name in uploads}
+        pending = []
+        # never wait past the deadline, even for a request stuck in a read
+        for f in as_completed(downloads, timeout=self.timeout(deadline)):
+            i = downloads[f]
+            data = f.result()
+            for name, options in uploads.items():
+                if options is None:
+                    results[name][i] = data
+                else:
+                    pending.append((name, i, self.executor.submit(
+                        self.upload, data, *options, deadline=deadline)))
+        for name, i, f in pending:
+            try:
+                picId = f.result(timeout=self.timeout(deadline))
+            except Exception as e:
+                results[name] = e
+                continue
+            if not isinstance(results[name], Exception):
+                results[name][i] = picId
+        return results
+
+    def timeout(self, deadline):
+        if deadline is None or deadline.expiresAt == float('inf'):
+            return None
+        return max(deadline.remaining(), 0)
+
+    def hedgeDelay(self):
+        '''
+        return: latency percentile of recent downloads, None if not hedging
+        '''
+        if not self.hedgePercentile:
+            return None
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.hedgePercentile), len(latencies) - 1)]
+
+    def get(self, url, semaphore, deadline=None):
+        '''
+        one request, semaphore is acquired by the caller and released here
+        '''
+        try:
+            start = time.monotonic()
+            with stage(deadline, 'download'):
+                data = tweet.getPhoto(url)
+            latency = time.monotonic() - start
+            metrics.observe('stage_seconds', latency, stage='download')
+            with self.lock:
+                self.latencies.append(latency)
+            return data
+        finally:
+            semaphore.release()
+
+    def download(self, url, deadline=None):
+        semaphore = self.limit(urlsplit(url).hostname)
+        semaphore.acquire()
+        delay = self.hedgeDelay()
+        if delay is None:
+            data = self.get(url, semaphore, deadline)
+        else:
+            data = self.hedge(url, semaphore, delay, deadline)
+        logging.debug('download %s - %s bytes', url, len(data))
+        return data
+
+    def hedge(self, url, semaphore, delay, deadline=None):
+        '''
+        send a second request if the first one takes longer than delay,
+        the slower one is left to finish in the background
+        '''
+        futures = [self.hedger.submit(self.get, url, semaphore, deadline)]
+        done, _ = wait(futures, timeout=delay)
+        # only hedge within the host limit
+        if not done and semaphore.acquire(blocking=False):
+            logging.debug('hedge download {} after {:.2f}s'.format(url, delay))
+            futures.append(self.hedger.submit(self.get, url, semaphore, deadline))
+        error = None
+        for f in as_completed(futures):
+            try:
+                return f.result()
+            except Exception as e:
+                error = e
+        raise error
+
+    def fetch(self, url, deadline=None):
+        if self.cache:
+            data = self.cache.fetch(url, lambda url: self.download(url, deadline))
+        else:
+            data = self.download(url, deadline)
+        if self.recompressor:
+            with metrics.timer('stage_seconds', stage='recompress'):
+                data = self.recompressor.apply(data, timeout=self.timeout(deadline))
+        return data
+
+    def upload(self, data, upload, uploadHost=None, uploadKey=None, deadline=None):
+        h = None
+        if self.cache and uploadKey is not None:
+            h = cache.digest(data)
+            picId = self.cache.getPicId(h, uploadKey)
+            if picId:
+                logging.debug('reuse pic_id {} - {}'.format(picId, uploadKey))
+                return picId
+        with self.limit(uploadHost), stage(deadline, 'upload'), \
+                metrics.timer('stage_seconds', stage='upload'):
+            picId = upload(data)
+        if h and picId:
+            self.cache.setPicId(h, picId, uploadKey)
+        return picId
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        if self.hedger:
+            self.hedger.shutdown(wait=False)
+        if self.recompressor:
+            self.recompressor.shutdown()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''metrics
+Stage latency histograms, counters and gauges in one process wide registry.
+Served in the Prometheus text format on a local `/metrics` endpoint and
+optionally dumped as JSON.
+see: https://prometheus.io/docs/instrumenting/exposition_formats/
+'''
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+PREFIX = 'retweet_'
+# histogram upper bounds, second
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = None
+_lock = threading.Lock()
+
+
+def labelKey(labels) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def formatLabels(key, extra=None) -> str:
+    items = list(key) + list(extra or ())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+class Histogram(object):
+    """cumulative bucket counts, sum and count"""
+
+    def __init__(self, buckets=BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        '''
+        estimate like Prometheus histogram_quantile, linear within a bucket
+        '''
+        if not self.count:
+            return 0
+        rank = q * self.count
+        lower, below = 0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+            lower, below = bound, count
+        return self.buckets[-1]
+
+    def toDict(self) -> dict:
+        return {
+            'buckets': dict(zip(map(str, self.buckets), self.counts)),
+            'sum': self.sum,
+            'count': self.count
+        }
+
+
+class Registry(object):
+    """name -> {labels -> value}"""
+
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # name -> (fn, label), evaluated on collect
+        self.callbacks = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[labelKey(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            if key not in values:
+                values[key] = Histogram()
+            values[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def gauge(self, name, fn, label=None):
+        '''
+        fn: () -> a number, or {label value: number} with label, called on collect
+        '''
+        self.callbacks[name] = fn, label
+
+    def collectGauges(self) -> dict:
+        with self.lock:
+            gauges = {name: dict(values) for name, values in self.gauges.items()}
+        for name, (fn, label) in list(self.callbacks.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                logging.warning('metrics {} - {!r}'.format(name, e))
+                continue
+            if value is None:
+                continue
+            if label:
+                gauges[name] = {((label, k),): v for k, v in value.items()}
+            else:
+                gauges[name] = {(): value}
+        return gauges
+
+    def render(self) -> str:
+        '''
+        return: Prometheus text format
+        '''
+        lines = []
+
+        def header(name, kind):
+            if name in self.help:
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, self.help[name]))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+        gauges = self.collectGauges()
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                header(name, 'counter')
+                for key, value in sorted(values.items()):
+                    lines.append('{}{}{} {}'.format(PREFIX, name, formatLabels(key), value))
+            for name, values in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                for key, h in sorted(values.items()):
+                    for bound, count in zip(h.buckets, h.counts):
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name, formatLabels(key, [('le', bound)]), count))
+                    lines.append('{}{}_bucket{} {}'.format(
+                        PREFIX, name, formatLabels(key, [('le', '+Inf')]), h.count))
+                    lines.append('{}{}_sum{} {}'.format(PREFIX, name, formatLabels(key), h.sum))
+                    lines.append('{}{}_count{} {}'.format(PREFIX, name, formatLabels(key), h.count))
+        for name, values in sorted(gauges.items()):
+            header(name, 'gauge')
+            for key, value in sorted(values.items()):
+                lines.append('{}{}{} {}'.format(PREFIX, name, formatLabels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def toDict(self) -> dict:
+        def flat(values, fn=lambda v: v):
+            return [dict(key, value=fn(value)) for key, value in sorted(values.items())]
+        gauges = self.collectGauges()
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': {name: flat(v) for name, v in self.counters.items()},
+                'histograms': {name: flat(v, Histogram.toDict) for name, v in self.histograms.items()},
+                'gauges': {name: flat(v) for name, v in gauges.items()}
+            }
+
+    def dump(self, path):
+        '''
+        write toDict() as JSON, atomically
+        '''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+        os.replace(tmp, path)
+
+
+def getRegistry() -> Registry:
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = Registry()
+        return _registry
+
+
+def reset() -> Registry:
+    '''
+    start over with an empty registry
+    '''
+    global _registry
+    with _lock:
+        _registry = Registry()
+        return _registry
+
+
+def inc(name, value=1, **labels):
+    getRegistry().inc(name, value, **labels)
+
+
+def setGauge(name, value, **labels):
+    getRegistry().set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    getRegistry().observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    return getRegistry().timer(name, **labels)
+
+
+def gauge(name, fn, label=None):
+    getRegistry().gauge(name, fn, label)
+
+
+def describe(name, text):
+    getRegistry().describe(name, text)
+
+
+def serve(port, host='127.0.0.1', registry=None):
+    '''
+    serve GET /metrics (Prometheus text) and /metrics.json in a daemon thread
+    '''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    registry = registry or getRegistry()
+
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/metrics':
+                body = registry.render().encode('utf-8')
+                contentType = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/metrics.json':
+                body = json.dumps(registry.toDict()).encode('utf-8')
+                contentType = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug('metrics - ' + format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info('metrics on http://{}:{}/metrics'.format(host, server.server_address[1]))
+    return server
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 
-import requests
+import time
+import hashlib
+import logging
 import mimetypes
+import threading
+
+import transport
 
 
 class WeiboAPI(object):
 
     headers = {
         'Accept': 'application/json, text/plain, */*',
-        'Accept-Encoding': ', deflate, br',
         'Accept-Language': 'zh-CN,zh;q=0.8,zh-TW;q=0.6,en;q=0.4',
-        'Connection': 'keep-alive',
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
         'X-Requested-With': 'XMLHttpRequest',
         'Host': 'm.weibo.cn',
@@ -19,20 +22,35 @@ class WeiboAPI(object):
     }
     upload_path = 'https://m.weibo.cn/api/statuses/uploadPic'
     post_path = 'https://m.weibo.cn/api/statuses/update'
+    config_path = 'https://m.weibo.cn/api/config'
+    st_ttl = 600  # second
 
-    def __init__(self, cookie):
-        self.headers['Cookie'] = cookie
+    def __init__(self, cookie, st_ttl=None, credentials=None):
+        self.headers = dict(self.headers, Cookie=cookie)
+        self.session = transport.getSession()
+        if st_ttl is not None:
+            self.st_ttl = st_ttl
+        # credentials.CredentialStore, share the st token across runs
+        self.credentials = credentials
+        self.credential_key = 'mweibo:' + hashlib.sha1(cookie.encode('utf-8')).hexdigest()[:12]
+        self._st = None
+        self._st_expires_at = 0
+        self._st_lock = threading.RLock()
 
     def upload_image(self, image):
         # {'name': ('filename', 'data', 'text/plain')}
         filename = getattr(image, 'name', 'img')
-        pauload = {
-            'type': (None, 'json'),
-            'pic': (filename, image, self.guess_content_type(filename)),
-            'st': (None, self.st)
-        }
-        resp = requests.post(
-            self.upload_path, headers=self.headers, files=pauload)
+        if hasattr(image, 'read'):
+            # read once, the request may be sent twice
+            image = image.read()
+
+        def payload(st):
+            return {'files': {
+                'type': (None, 'json'),
+                'pic': (filename, image, self.guess_content_type(filename)),
+                'st': (None, st)
+            }}
+        resp = self._post_with_st(self.upload_path, payload)
         # success
         # {
         #   "pic_id":"PIC_ID",
@@ -53,24 +71,70 @@ class WeiboAPI(object):
         return js
 
     def post(self, content, pic=None):
-        data = {'content': content, 'st': self.st}
+        data = {'content': content}
         if pic:
             if not isinstance(pic, list):
                 pic = [pic]
             pic = list(map(lambda p: self.upload_image(p).get('pic_id') if hasattr(
-                p, 'read') or isinstance(p, bytes) else p, pic))
+                p, 'read') or isinstance(p, (bytes, memoryview)) else p, pic))
             pic = ','.join(pic)
             data['picId'] = pic
-        resp = requests.post(self.post_path, headers=self.headers, data=data)
+        resp = self._post_with_st(
+            self.post_path, lambda st: {'data': dict(data, st=st)})
         try:
-            return resp.json()
+            js = resp.json()
         except:
             raise WeiboPostError(resp.text)
+        if js.get('ok', 1) != 1:
+            raise WeiboPostError(resp.text)
+        return js
+
+    def _post_with_st(self, url, payload):
+        '''
+        POST with the cached st token
+        refresh the token and retry once if it is rejected
+        payload: st -> requests kwargs
+        '''
+        resp = self.session.post(url, headers=self.headers, **payload(self.st))
+        if not self.is_token_error(resp):
+            return resp
+        logging.info('st token rejected, refresh and retry - {}'.format(url))
+        st = self.refresh_st(rejected=True)
+        return self.session.post(url, headers=self.headers, **payload(st))
+
+    @staticmethod
+    def is_token_error(resp):
+        # {'ok': 0, 'msg': 'token校验失败', 'errno': '100006'}
+        try:
+            js = resp.json()
+        except ValueError:
+            return False
+        return isinstance(js, dict) and str(js.get('errno')) == '100006'
 
     @property
     def st(self):
-        return requests.get(
-            "https://m.weibo.cn/api/config", headers=self.headers).json()['data']['st']
+        with self._st_lock:
+            if not self._st or self._st_expires_at <= time.time():
+                self.refresh_st()
+            return self._st
+
+    def refresh_st(self, rejected=False):
+        with self._st_lock:
+            if self.credentials is None:
+                value = self._fetch_st()
+            else:
+                if rejected:
+                    self.credentials.invalidate(self.credential_key, {
+                        'access_token': self._st, 'expires_at': self._st_expires_at})
+                value = self.credentials.fetch(self.credential_key, self._fetch_st)
+            self._st = value['access_token']
+            self._st_expires_at = value['expires_at']
+            return self._st
+
+    def _fetch_st(self):
+        st = self.session.get(
+            self.config_path, headers=self.headers).json()['data']['st']
+        return {'access_token': st, 'expires_at': time.time() + self.st_ttl}
 
     @staticmethod
     def guess_content_type(url):
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''outbox
+Durable SQLite queue between fetching tweets and posting them.
+Failed items are retried with exponential backoff and end up `dead`
+after `maxAttempts`. A claimed item is `inflight` under a lease of the
+claiming process, items whose lease ran out (a crash) are retried.
+With several destinations, `delivered` keeps the result of each one so a
+retry only posts to the destinations which failed.
+'''
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import sqlite3
+import threading
+
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+DONE = 'done'
+DEAD = 'dead'
+
+MAX_ATTEMPTS = 5
+BACKOFF = 30  # second, doubled after every failure
+MAX_BACKOFF = 60 * 60
+RETENTION = 7 * 24 * 60 * 60  # keep done items, second
+LEASE = 10 * 60  # second an item stays claimed, longer than any post
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    delivered TEXT,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_at);
+'''
+
+
+class Outbox(object):
+    """SQLite backed outbox"""
+
+    def __init__(self, path, maxAttempts=MAX_ATTEMPTS, backoff=BACKOFF, maxBackoff=MAX_BACKOFF,
+                 lease=LEASE):
+        super(Outbox, self).__init__()
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.lease = lease
+        # processes (and outboxes of one process) sharing the file tell their claims apart
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+        self.recover()
+
+    def migrate(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(outbox)')]
+        if 'delivered' not in columns:
+            self.conn.execute('ALTER TABLE outbox ADD COLUMN delivered TEXT')
+        if 'owner' not in columns:
+            self.conn.execute('ALTER TABLE outbox ADD COLUMN owner TEXT')
+        if 'lease_until' not in columns:
+            self.conn.execute('ALTER TABLE outbox ADD COLUMN lease_until REAL')
+
+    def recover(self) -> int:
+        '''
+        retry inflight items whose lease ran out, claims of live processes are kept
+        called on start and periodically, items without a lease predate leases
+        return: number of items retried
+        '''
+        with self.lock:
+            n = self.conn.execute(
+                'UPDATE outbox SET state = ?, owner = NULL, lease_until = NULL WHERE state = ? AND (lease_until IS NULL OR lease_until < ?)',
+                (PENDING, INFLIGHT, time.time())).rowcount
+        if n:
+            logging.info('outbox - retry {} inflight items with an expired lease'.format(n))
+        return n
+
+    def put(self, key, payload) -> bool:
+        '''
+        enqueue payload once per key
+        return: False if key was already queued
+        '''
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute(
+                'INSERT OR IGNORE INTO outbox (key, payload, state, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (str(key), json.dumps(payload), PENDING, now, now, now))
+        return cur.rowcount > 0
+
+    def claim(self):
+        '''
+        return: (id, payload) of the oldest ready item, None if empty
+        '''
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(
+                    'SELECT id, payload FROM outbox WHERE state = ? AND next_at <= ? ORDER BY id LIMIT 1',
+                    (PENDING, now)).fetchone()
+                if row:
+                    self.conn.execute(
+                        'UPDATE outbox SET state = ?, attempts = attempts + 1, owner = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                        (INFLIGHT, self.owner, now + self.lease, now, row[0]))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def delivered(self, id) -> dict:
+        '''
+        return: {destination: {'state', 'attempts', 'error'}}
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT delivered FROM outbox WHERE id = ?', (id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def deliver(self, id, destination, error=None):
+        '''
+        record one destination of an item, posted if error is None
+        '''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(
+                    'SELECT delivered FROM outbox WHERE id = ?', (id,)).fetchone()
+                delivered = json.loads(row[0]) if row and row[0] else {}
+                entry = delivered.get(destination, {'attempts': 0})
+                entry['attempts'] += 1
+                entry['state'] = DONE if error is None else PENDING
+                entry['error'] = None if error is None else str(error)
+                delivered[destination] = entry
+                self.conn.execute(
+                    'UPDATE outbox SET delivered = ?, updated_at = ? WHERE id = ?',
+                    (json.dumps(delivered), time.time(), id))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def done(self, id):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE outbox SET state = ?, error = NULL, updated_at = ? WHERE id = ?',
+                (DONE, time.time(), id))
+
+    def fail(self, id, error) -> str:
+        '''
+        schedule a retry with exponential backoff, or mark dead
+        return: new state
+        '''
+        now = time.time()
+        with self.lock:
+            attempts = self.conn.execute(
+                'SELECT attempts FROM outbox WHERE id = ?', (id,)).fetchone()[0]
+            if attempts >= self.maxAttempts:
+                state, nextAt = DEAD, now
+            else:
+                state = PENDING
+                nextAt = now + min(self.backoff * 2 ** (attempts - 1), self.maxBackoff)
+            self.conn.execute(
+                'UPDATE outbox SET state = ?, next_at = ?, error = ?, updated_at = ? WHERE id = ?',
+                (state, nextAt, str(error), now, id))
+        return state
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM outbox WHERE state IN (?, ?)', (PENDING, INFLIGHT)).fetchone()[0]
+
+    def oldest(self):
+        '''
+        return: created_at of the oldest unposted item, None if empty
+        '''
+        with self.lock:
+            return self.conn.execute(
+                'SELECT MIN(created_at) FROM outbox WHERE state IN (?, ?)', (PENDING, INFLIGHT)).fetchone()[0]
+
+    def purge(self, retention=RETENTION):
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM outbox WHERE state = ? AND updated_at < ?', (DONE, time.time() - retention))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''scheduler
+Adaptive poll interval per account.
+Poll an account at `minInterval` while it is active and back off towards
+`maxInterval` while it is idle, but never faster than the remaining
+rate limit budget (shared by all accounts) allows.
+On HTTP 429 every account waits until the window resets.
+see: https://developer.twitter.com/en/docs/basics/rate-limiting
+'''
+
+import time
+import logging
+import threading
+
+MIN_INTERVAL = 10  # second
+MAX_INTERVAL = 300  # second
+BACKOFF = 1.5
+
+
+class Scheduler(object):
+    """next poll time from activity and x-rate-limit-* headers"""
+
+    def __init__(self, keys, minInterval=MIN_INTERVAL, maxInterval=MAX_INTERVAL, backoff=BACKOFF):
+        super(Scheduler, self).__init__()
+        self.minInterval = minInterval
+        self.maxInterval = max(maxInterval, minInterval)
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.dueAt = {}
+        self.suspendUntil = 0
+        now = time.time()
+        keys = list(keys)
+        for i, key in enumerate(keys):
+            self.intervals[key] = self.minInterval
+            # spread the first polls over minInterval
+            self.dueAt[key] = now + self.minInterval * i / len(keys)
+
+    def budget(self, rateLimit) -> float:
+        '''
+        seconds between two polls of one account that spend the remaining
+        budget evenly over all accounts until the window resets
+        '''
+        if not rateLimit:
+            return 0
+        window = max(rateLimit['reset'] - time.time(), 0)
+        remaining = rateLimit['remaining'] / len(self.intervals)
+        if remaining < 1:
+            return window
+        return window / remaining
+
+    def next(self, key, active, rateLimit=None) -> float:
+        '''
+        active: the last poll found new tweets
+        return: delay before the next poll of key, second
+        '''
+        with self.lock:
+            if active:
+                interval = self.minInterval
+            else:
+                interval = min(self.intervals[key] * self.backoff, self.maxInterval)
+            self.intervals[key] = interval
+            delay = max(interval, self.budget(rateLimit))
+            self.dueAt[key] = time.time() + delay
+        logging.debug('%s - next poll in %.1fs', key, delay)
+        return delay
+
+    def defer(self, key, delay):
+        '''
+        look at key again after delay, its interval is unchanged
+        '''
+        with self.lock:
+            self.dueAt[key] = time.time() + delay
+
+    def limited(self, key, reset) -> float:
+        '''
+        HTTP 429, suspend all polls until the rate limit window resets
+        '''
+        delay = max(reset - time.time(), 0) + 1
+        with self.lock:
+            self.suspendUntil = max(self.suspendUntil, time.time() + delay)
+            self.dueAt[key] = self.suspendUntil
+        logging.warning('rate limit exceeded, suspend {:.0f}s'.format(delay))
+        return delay
+
+    def ready(self) -> list:
+        '''
+        return: keys due for a poll, they are not due again until `next`
+        or `limited` is called for them
+        '''
+        now = time.time()
+        with self.lock:
+            if now < self.suspendUntil:
+                return []
+            keys = [key for key, due in self.dueAt.items() if due <= now]
+            for key in keys:
+                self.dueAt[key] = float('inf')
+            return keys
+
+    def wait(self) -> float:
+        '''
+        return: seconds until the next key is due
+        '''
+        with self.lock:
+            due = max(min(self.dueAt.values()), self.suspendUntil)
+        return max(due - time.time(), 0)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+'''shard
+Worker mode: split the monitored accounts between several processes, on
+one host or more, by consistent hashing over the live workers.
+Every worker renews its lease in a shared store (heartbeat), a worker whose
+lease ran out drops out of the ring and its accounts move to the others.
+An account is only polled by the worker holding its `poll:` lease, so a
+rebalance never polls it twice. The store also keeps the since_id cursors,
+the outbox and the dedup index, so any worker posts what another queued.
+SQLiteStore is for the processes of one host: WAL needs shared memory and
+does not work over a network file system. Workers on several hosts need
+another backend implementing all of Store.
+'''
+
+import os
+import json
+import time
+import bisect
+import socket
+import hashlib
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+import dedup
+import outbox
+
+TTL = 30  # lease, second
+REPLICAS = 64  # points per worker on the ring
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+'''
+
+
+class Store(ABC):
+    """state shared by the workers, get/set like store.StateFile plus leases, outbox and dedup index"""
+
+    @abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abstractmethod
+    def acquire(self, name, owner, ttl) -> bool:
+        '''
+        take or renew lease `name` for ttl seconds
+        return: False if another owner holds it
+        '''
+
+    @abstractmethod
+    def release(self, name, owner):
+        pass
+
+    @abstractmethod
+    def members(self) -> list:
+        '''
+        return: ids of the workers with a live `worker:` lease
+        '''
+
+    @abstractmethod
+    def openOutbox(self, **kwargs):
+        '''
+        the queue of all the workers, kwargs of outbox.Outbox
+        return: an object with the methods of outbox.Outbox
+        '''
+
+    @abstractmethod
+    def openIndex(self, **kwargs):
+        '''
+        the posted index of all the workers, kwargs of dedup.Index
+        return: an object with the methods of dedup.Index
+        '''
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(Store):
+    """Store in one SQLite file, processes of one host only"""
+
+    def __init__(self, path):
+        super(SQLiteStore, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def acquire(self, name, owner, ttl) -> bool:
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute(
+                'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.owner = excluded.owner OR leases.expires_at <= ?',
+                (name, owner, now + ttl, now))
+        return cur.rowcount > 0
+
+    def release(self, name, owner):
+        with self.lock:
+            self.conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+    def members(self) -> list:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT owner FROM leases WHERE name LIKE 'worker:%' AND expires_at > ?",
+                (time.time(),)).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def openOutbox(self, **kwargs):
+        return outbox.Outbox(self.path, **kwargs)
+
+    def openIndex(self, **kwargs):
+        return dedup.Index(self.path, **kwargs)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def hash64(key) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class Ring(object):
+    """consistent hash ring, a worker joining or leaving only moves its own share"""
+
+    def __init__(self, members, replicas=REPLICAS):
+        super(Ring, self).__init__()
+        self.members = sorted(members)
+        self.points = sorted((hash64('{}#{}'.format(m, i)), m)
+                             for m in self.members for i in range(replicas))
+        self.hashes = [h for h, _ in self.points]
+
+    def owner(self, key):
+        '''
+        return: worker id owning key, None without workers
+        '''
+        if not self.points:
+            return None
+        i = bisect.bisect(self.hashes, hash64(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class Shard(object):
+    """membership and account leases of this worker"""
+
+    def __init__(self, store, workerId=None, ttl=TTL):
+        super(Shard, self).__init__()
+        self.store = store
+        self.workerId = workerId or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.owned = set()
+        self.ring = Ring([self.workerId])
+
+    def heartbeat(self):
+        '''
+        renew the leases of this worker and rebuild the ring from the live workers
+        '''
+        self.store.acquire('worker:' + self.workerId, self.workerId, self.ttl)
+        members = self.store.members()
+        if self.workerId not in members:
+            members.append(self.workerId)
+        ring = Ring(members)
+        if ring.members != self.ring.members:
+            logging.info('shard - workers {}'.format(', '.join(ring.members)))
+        with self.lock:
+            self.ring = ring
+            owned = list(self.owned)
+        for key in owned:
+            if ring.owner(key) == self.workerId and \
+                    self.store.acquire('poll:' + key, self.workerId, self.ttl):
+                continue
+            # moved to another worker
+            self.store.release('poll:' + key, self.workerId)
+            with self.lock:
+                self.owned.discard(key)
+
+    def owns(self, key) -> bool:
+        '''
+        return: True if this worker should poll key now
+        '''
+        with self.lock:
+            ring = self.ring
+        if ring.owner(key) != self.workerId:
+            return False
+        # the previous owner may not have seen the new ring yet
+        if not self.store.acquire('poll:' + key, self.workerId, self.ttl):
+            return False
+        with self.lock:
+            self.owned.add(key)
+        return True
+
+    def start(self, stop):
+        '''
+        heartbeat every ttl / 3 in a daemon thread until stop is set
+        '''
+        def run():
+            while not stop.wait(self.ttl / 3):
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logging.exception('shard heartbeat - {}'.format(e))
+        self.heartbeat()
+        threading.Thread(target=run, name='shard', daemon=True).start()
+
+    def leave(self):
+        '''
+        hand the accounts over right away instead of after ttl
+        '''
+        with self.lock:
+            owned, self.owned = self.owned, set()
+        for key in owned:
+            self.store.release('poll:' + key, self.workerId)
+        self.store.release('worker:' + self.workerId, self.workerId)
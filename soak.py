@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+'''soak
+Run thousands of main.loop cycles back to back against the local stubs in
+stubs.py and watch for slow creep, as a regression gate for the daemon:
+    python soak.py --cycles 2000 --max-rss 20 --max-heap 5
+Samples RSS, tracemalloc, open file descriptors and the connections of the
+transport pools every `--every` cycles after `--warmup`, then exits 1 when
+any of them grew more than its limit from the start to the end of the run.
+--daemon SECONDS runs main.daemon instead, the long running mode with the
+poll scheduler, post worker threads and poll executor, publishing tweets
+every second and sampling every `--sample-every` seconds after the first
+fifth of the run:
+    python soak.py --daemon 3600 --sample-every 60
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+import stubs
+import bench
+
+TOP = 10  # allocation sites shown on failure
+# --daemon polls every account about this often, second
+DAEMON_INTERVAL = 2
+DAEMON_MIN_INTERVAL = 0.5
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='soak main.loop against local stubs')
+    parser.add_argument('--backend', choices=('mweibo', 'weibo'), default='mweibo')
+    parser.add_argument('--accounts', type=int, default=2)
+    parser.add_argument('--tweets', type=int, default=2, help='new tweets per account per cycle')
+    parser.add_argument('--photos', type=int, default=1, help='photos per tweet')
+    parser.add_argument('--photo-size', type=int, default=16 * 1024, help='byte')
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200, help='cycles before the first sample')
+    parser.add_argument('--every', type=int, default=100, help='cycles between two samples')
+    parser.add_argument('--daemon', type=float, default=None, metavar='SECONDS',
+                        help='run main.daemon for this long instead of main.loop cycles')
+    parser.add_argument('--sample-every', type=float, default=10, help='second between two samples, --daemon')
+    parser.add_argument('--error-rate', type=float, default=0, help='0 ~ 1 per request')
+    parser.add_argument('--cache', action='store_true', help='enable MEDIA_CACHE')
+    parser.add_argument('--hedge', type=float, default=None, help='HEDGE_PERCENTILE')
+    parser.add_argument('--no-tracemalloc', action='store_true', help='faster, without heap samples')
+    parser.add_argument('--max-rss', type=float, default=20, help='MiB')
+    parser.add_argument('--max-heap', type=float, default=5, help='MiB traced by tracemalloc')
+    parser.add_argument('--max-fds', type=int, default=10)
+    parser.add_argument('--max-connections', type=int, default=10, help='new pool connections')
+    parser.add_argument('--json', help='also write the samples to this file')
+    return parser.parse_args(argv)
+
+
+def rss() -> int:
+    '''
+    return: resident set size, byte
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # no procfs, the peak is the best there is
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def fds():
+    '''
+    return: open file descriptors, None if unknown
+    '''
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+
+def connections(session) -> dict:
+    '''
+    return: pools, connections opened so far and idle ones of the session adapters
+    '''
+    # a pool queue starts full of None placeholders, only real connections are idle
+    result = {'pools': 0, 'opened': 0, 'idle': 0}
+    for adapter in set(session.adapters.values()):
+        manager = getattr(adapter, 'poolmanager', None)
+        if manager is None:
+            continue
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            result['pools'] += 1
+            result['opened'] += pool.num_connections
+            if pool.pool:
+                result['idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    return result
+
+
+def sample(cycle, session) -> dict:
+    s = {'cycle': cycle, 'time': time.monotonic(), 'rss': rss(), 'fds': fds()}
+    s.update(connections(session))
+    if tracemalloc.is_tracing():
+        s['heap'] = tracemalloc.get_traced_memory()[0]
+    return s
+
+
+def growth(samples, key):
+    '''
+    median of the last three samples minus median of the first three
+    '''
+    values = [s[key] for s in samples if s.get(key) is not None]
+    if len(values) < 2:
+        return None
+    n = min(3, len(values) // 2)
+    return sorted(values[-n:])[n // 2] - sorted(values[:n])[n // 2]
+
+
+def check(args, samples) -> list:
+    '''
+    return: failures
+    '''
+    MiB = 1024 * 1024
+    limits = (
+        ('rss', args.max_rss * MiB, MiB, 'MiB'),
+        ('heap', args.max_heap * MiB, MiB, 'MiB'),
+        ('fds', args.max_fds, 1, ''),
+        ('opened', args.max_connections, 1, '')
+    )
+    failures = []
+    for key, limit, unit, suffix in limits:
+        g = growth(samples, key)
+        if g is None:
+            continue
+        print('{:<8}{:>+12.2f}{:<4} limit {:.2f}{}'.format(key, g / unit, suffix, limit / unit, suffix))
+        if g > limit:
+            failures.append(key)
+    return failures
+
+
+def report(s):
+    print('{} {} - rss {:.1f}MiB heap {:.1f}MiB fds {} connections {}/{}'.format(
+        'second' if 'second' in s else 'cycle', s.get('second', s['cycle']),
+        s['rss'] / 1024 / 1024, s.get('heap', 0) / 1024 / 1024, s['fds'],
+        s['idle'], s['opened']))
+
+
+def runLoop(args, stub, app, session):
+    '''
+    main.loop back to back
+    return: samples, tracemalloc snapshot of the first one
+    '''
+    samples = []
+    first = None
+    start = time.monotonic()
+    for cycle in range(1, args.cycles + 1):
+        stub.publish(args.tweets)
+        app.loop()
+        if cycle < args.warmup or (cycle - args.warmup) % args.every:
+            continue
+        if first is None and tracemalloc.is_tracing():
+            first = tracemalloc.take_snapshot()
+        s = sample(cycle, session)
+        samples.append(s)
+        report(s)
+    elapsed = time.monotonic() - start
+    print('{} cycles in {:.1f}s, {:.1f} cycles/sec'.format(args.cycles, elapsed, args.cycles / elapsed))
+    return samples, first
+
+
+def runDaemon(args, stub, app, session):
+    '''
+    main.daemon in a thread, args.tweets published per account every second
+    return: samples, tracemalloc snapshot of the first one
+    '''
+    stop = threading.Event()
+    thread = threading.Thread(target=app.daemon, args=(stop,), name='daemon', daemon=True)
+    thread.start()
+    samples = []
+    first = None
+    start = time.monotonic()
+    warmup = args.daemon / 5
+    nextSample = start + warmup
+    cycle = 0
+    while time.monotonic() - start < args.daemon:
+        cycle += 1
+        stub.publish(args.tweets)
+        time.sleep(1)
+        if time.monotonic() < nextSample:
+            continue
+        nextSample += args.sample_every
+        if first is None and tracemalloc.is_tracing():
+            first = tracemalloc.take_snapshot()
+        s = sample(cycle, session)
+        s['second'] = int(time.monotonic() - start)
+        samples.append(s)
+        report(s)
+    stop.set()
+    thread.join(10)
+    # the post workers finish the drain they are in
+    for worker in threading.enumerate():
+        if worker.name.startswith('worker-'):
+            worker.join(10)
+    import metrics
+    posted = metrics.getRegistry().counters.get('tweets_posted_total', {})
+    print('{:.0f}s, {} tweets published, {} posted, {} pending'.format(
+        time.monotonic() - start, cycle * args.tweets * args.accounts,
+        sum(posted.values()), app.tweetOutbox.depth()))
+    return samples, first
+
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.WARNING)
+    stub = stubs.Stub(
+        ['soak{}'.format(i) for i in range(args.accounts)],
+        photos=args.photos,
+        photoSize=args.photo_size,
+        errorRate=args.error_rate,
+        keep=200).serve()
+    workdir = tempfile.mkdtemp(prefix='retweet-soak-')
+    config = bench.loadConfig(args, workdir, stub)
+    if args.daemon:
+        config.INTERVAL = DAEMON_INTERVAL
+        config.MIN_INTERVAL = DAEMON_MIN_INTERVAL
+
+    import main as app
+    import transport
+    logging.getLogger().setLevel(logging.WARNING)
+    app.init()
+    transport.route(stub.routes())
+    session = transport.getSession()
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    if args.daemon:
+        samples, first = runDaemon(args, stub, app, session)
+    else:
+        samples, first = runLoop(args, stub, app, session)
+
+    failures = check(args, samples)
+    if failures and first is not None:
+        last = tracemalloc.take_snapshot()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        print('\ntop growth by allocation site')
+        stats = last.filter_traces(ignore).compare_to(first.filter_traces(ignore), 'lineno')
+        for stat in stats[:TOP]:
+            print(stat)
+    app.mediaPipeline.shutdown()
+    stub.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'samples': samples, 'failures': failures}, f, indent=2)
+    if failures:
+        print('\ngrowth over the limit - {}'.format(', '.join(failures)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
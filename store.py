@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''store
+Small on-disk state shared between runs (cursors, tokens ...)
+'''
+
+import os
+import json
+import logging
+import threading
+
+
+class StateFile(object):
+    """JSON backed key/value state, written atomically"""
+
+    def __init__(self, path, mode=0o666):
+        '''
+        mode: permissions of the file before the umask, 0o600 for secrets
+        '''
+        super(StateFile, self).__init__()
+        self.path = path
+        self.mode = mode
+        self.lock = threading.RLock()
+        self.data = self.load()
+
+    def load(self) -> dict:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning('load state {} fail - {}'.format(self.path, e))
+            return {}
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            try:
+                # a leftover of a crash keeps its own mode
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            # created with the mode, the file is never readable by others in between
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, self.mode)
+            with open(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.save()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+'''stream
+Push ingestion through the Twitter API v2 filtered stream.
+Tweets of the monitored accounts arrive over one long-lived connection
+(rule `from:name OR ...`), are converted to tweet.TweetRecord and handed
+to `onTweet`. Twitter sends a keep-alive newline every 20s, a silent
+connection is dropped after `heartbeat` seconds and reconnected with
+exponential backoff.
+see: https://developer.twitter.com/en/docs/twitter-api/tweets/filtered-stream/introduction
+'''
+
+import logging
+import datetime
+import threading
+
+import tweet
+import transport
+
+STREAM_URL = 'https://api.twitter.com/2/tweets/search/stream'
+RULES_URL = STREAM_URL + '/rules'
+RULE_TAG = 'retweet'
+RULE_LENGTH = 512
+HEARTBEAT = 30  # second
+BACKOFF = 1  # second, doubled after every failure
+MAX_BACKOFF = 320
+RATE_LIMIT_BACKOFF = 60
+
+
+def buildRules(screenNames) -> list:
+    '''
+    return: rule values, `from:a OR from:b ...` no longer than RULE_LENGTH
+    '''
+    rules = []
+    rule = ''
+    for name in screenNames:
+        term = 'from:' + name
+        if rule and len(rule) + len(' OR ') + len(term) > RULE_LENGTH:
+            rules.append(rule)
+            rule = ''
+        rule = rule + ' OR ' + term if rule else term
+    if rule:
+        rules.append(rule)
+    return rules
+
+
+def toRecord(data, includes):
+    '''
+    v2 tweet -> tweet.TweetRecord
+    see: https://developer.twitter.com/en/docs/twitter-api/data-dictionary/object-model/tweet
+    '''
+    users = {u['id']: u for u in includes.get('users', [])}
+    media = {m['media_key']: m for m in includes.get('media', [])}
+    createdAt = datetime.datetime.strptime(
+        data['created_at'], '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    photos = []
+    for key in data.get('attachments', {}).get('media_keys', []):
+        m = media.get(key)
+        if m and m.get('type') == 'photo':
+            photos.append(m.get('url'))
+    referenced = [r.get('type') for r in data.get('referenced_tweets', [])]
+    return tweet.TweetRecord(
+        int(data['id']),
+        screenName=users.get(data.get('author_id'), {}).get('username'),
+        createdAt=createdAt,
+        text=data.get('text', ''),
+        photos=photos,
+        isRetweet='retweeted' in referenced,
+        isReply='replied_to' in referenced,
+        lang=data.get('lang'))
+
+
+class Stream(object):
+    """filtered stream consumer, `connected` is set while tweets flow"""
+
+    def __init__(self, tweetClient, onTweet, heartbeat=HEARTBEAT, connectTimeout=5,
+                 backoff=BACKOFF, rateLimitBackoff=RATE_LIMIT_BACKOFF):
+        '''
+        tweetClient: tweet.Tweet, for the session, bearer token and screen names
+        onTweet: (screenName, tweet) -> None
+        backoff: second before the first reconnect, doubled up to MAX_BACKOFF
+        rateLimitBackoff: second at least before reconnecting after HTTP 429
+        '''
+        super(Stream, self).__init__()
+        self.tweetClient = tweetClient
+        self.onTweet = onTweet
+        self.heartbeat = heartbeat
+        self.connectTimeout = connectTimeout
+        self.backoff = backoff
+        self.rateLimitBackoff = rateLimitBackoff
+        self.connected = threading.Event()
+
+    def setRules(self):
+        client = self.tweetClient
+        resp = client.request('GET', RULES_URL)
+        resp.raise_for_status()
+        current = [r for r in resp.json().get('data', []) if r.get('tag') == RULE_TAG]
+        rules = buildRules(self.tweetClient.screenNames)
+        if sorted(r['value'] for r in current) == sorted(rules):
+            return
+        if current:
+            resp = client.request('POST', RULES_URL,
+                                  json={'delete': {'ids': [r['id'] for r in current]}})
+            resp.raise_for_status()
+        resp = client.request('POST', RULES_URL,
+                              json={'add': [{'value': r, 'tag': RULE_TAG} for r in rules]})
+        resp.raise_for_status()
+        logging.info('stream rules - {}'.format(rules))
+
+    def connect(self):
+        '''
+        read the stream until it breaks
+        '''
+        resp = self.tweetClient.request(
+            'GET',
+            STREAM_URL,
+            # only the fields TweetRecord needs
+            params={
+                'expansions': 'author_id,attachments.media_keys',
+                'tweet.fields': 'created_at,lang,attachments,referenced_tweets',
+                'user.fields': 'username',
+                'media.fields': 'type,url'
+            },
+            stream=True,
+            # the read timeout is the heartbeat check
+            timeout=(self.connectTimeout, self.heartbeat))
+        with resp:
+            if resp.status_code != 200:
+                raise StreamError(resp.status_code, resp.text)
+            self.connected.set()
+            logging.info('stream connected')
+            for line in resp.iter_lines():
+                if not line:
+                    continue  # keep-alive
+                js = transport.loads(line)
+                if 'data' not in js:
+                    logging.warning('stream message - {}'.format(js))
+                    continue
+                t = toRecord(js['data'], js.get('includes', {}))
+                self.onTweet(t.screenName, t)
+
+    def run(self, stop):
+        '''
+        keep the stream connected until stop is set
+        '''
+        backoff = self.backoff
+        while not stop.is_set():
+            try:
+                self.setRules()
+                self.connect()
+            except StreamError as e:
+                if e.status == 429:
+                    backoff = max(backoff, self.rateLimitBackoff)
+                logging.warning('stream fail - {}'.format(e))
+            except Exception as e:
+                logging.warning('stream disconnected - {!r}'.format(e))
+            finally:
+                if self.connected.is_set():
+                    # it was up, a drop starts over from the first backoff
+                    backoff = self.backoff
+                self.connected.clear()
+            logging.info('stream reconnect in {}s'.format(backoff))
+            stop.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def start(self, stop) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run, args=(stop,), name='stream', daemon=True)
+        thread.start()
+        return thread
+
+
+class StreamError(Exception):
+    def __init__(self, status, text):
+        super(StreamError, self).__init__('{} - {}'.format(status, text))
+        self.status = status
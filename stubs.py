@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+'''stubs
+Local stand-ins for the Twitter, pbs.twimg.com and Weibo endpoints, for
+bench.py. Requests are routed here with transport.route(), the path starts
+with the original host: http://127.0.0.1:<port>/<host>/<path>.
+Each endpoint adds `latency` seconds and fails with `errorRate`.
+The v2 filtered stream sends a keep-alive newline every `keepAlive` seconds
+and every tweet published while connected, `streamPlan` scripts how the next
+connections end (HTTP 429, dropped, or silent) for stream.Stream checks.
+'''
+
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOSTS = ('api.twitter.com', 'pbs.twimg.com', 'api.weibo.com', 'm.weibo.cn')
+RATE_LIMIT = 900
+STREAM = 'GET api.twitter.com/2/tweets/search/stream'
+STREAM_RULES = 'api.twitter.com/2/tweets/search/stream/rules'
+
+
+class Stub(object):
+    """generated timelines and canned Weibo responses, counts every request"""
+
+    def __init__(self, screenNames, photos=1, photoSize=64 * 1024, latency=0, errorRate=0, keep=None,
+                 keepAlive=20, streamPlan=(), dropAfter=5):
+        '''
+        photos: photos per tweet
+        latency: second, or {endpoint: second}
+        errorRate: 0 ~ 1, or {endpoint: rate}
+        keep: latest tweets kept per account, None keeps them all
+        keepAlive: second between two keep-alive newlines of the stream
+        streamPlan: one entry per stream connection, 429 answers HTTP 429,
+            'drop' closes the connection and 'stall' goes silent without closing
+            it, both after dropAfter seconds. Connections past the plan stay up
+        '''
+        super(Stub, self).__init__()
+        self.screenNames = list(screenNames)
+        self.photos = photos
+        self.photo = bytes(random.getrandbits(8) for _ in range(photoSize))
+        self.latency = latency
+        self.errorRate = errorRate
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.timelines = {name: [] for name in self.screenNames}
+        self.nextId = 1000
+        self.counts = {}
+        self.server = None
+        self.keepAlive = keepAlive
+        self.streamPlan = list(streamPlan)
+        self.dropAfter = dropAfter
+        self.rules = []
+        self.nextRuleId = 1
+        self.streams = []  # message queues of the connected streams
+        self.closed = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def publish(self, n=1):
+        '''
+        n new tweets for every account
+        '''
+        now = time.gmtime()
+        # Wed Oct 10 20:19:24 +0000 2018
+        createdAt = time.strftime('%a %b %d %H:%M:%S +0000 %Y', now)
+        with self.lock:
+            for name in self.screenNames:
+                for _ in range(n):
+                    self.nextId += 1
+                    id = self.nextId
+                    t = {
+                        'id': id,
+                        'created_at': createdAt,
+                        'full_text': 'stub tweet {} of {}'.format(id, name),
+                        'lang': 'en',
+                        'user': {'screen_name': name},
+                        'extended_entities': {'media': [
+                            {'type': 'photo', 'media_url_https': 'https://pbs.twimg.com/media/{}_{}.jpg'.format(id, i)}
+                            for i in range(self.photos)]}
+                    }
+                    self.timelines[name].append(t)
+                    if self.streams:
+                        message = self.streamMessage(t, now)
+                        for q in self.streams:
+                            q.put(message)
+                if self.keep:
+                    del self.timelines[name][:-self.keep]
+
+    def published(self) -> set:
+        '''
+        return: ids of every tweet kept in the timelines
+        '''
+        with self.lock:
+            return {t['id'] for l in self.timelines.values() for t in l}
+
+    def streamMessage(self, t, now) -> bytes:
+        '''
+        v1.1 stub tweet -> v2 stream message, the screen name is the user id
+        '''
+        name = t['user']['screen_name']
+        media = [{'media_key': '3_{}_{}'.format(t['id'], i), 'type': 'photo', 'url': m['media_url_https']}
+                 for i, m in enumerate(t['extended_entities']['media'])]
+        js = {
+            'data': {
+                'id': str(t['id']),
+                'text': t['full_text'],
+                'author_id': name,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', now),
+                'lang': t['lang'],
+                'attachments': {'media_keys': [m['media_key'] for m in media]}
+            },
+            'includes': {'users': [{'id': name, 'username': name}], 'media': media},
+            'matching_rules': [{'id': r['id'], 'tag': r.get('tag')} for r in self.rules]
+        }
+        return json.dumps(js).encode('utf-8') + b'\r\n'
+
+    def updateRules(self, body) -> dict:
+        '''
+        POST tweets/search/stream/rules, add or delete
+        '''
+        with self.lock:
+            if 'delete' in body:
+                ids = set(body['delete'].get('ids', []))
+                deleted = [r for r in self.rules if r['id'] in ids]
+                self.rules = [r for r in self.rules if r['id'] not in ids]
+                return {'meta': {'summary': {'deleted': len(deleted)}}}
+            added = []
+            for rule in body.get('add', []):
+                added.append(dict(rule, id=str(self.nextRuleId)))
+                self.nextRuleId += 1
+            self.rules.extend(added)
+            return {'data': added, 'meta': {'summary': {'created': len(added)}}}
+
+    def stream(self, handler):
+        '''
+        GET tweets/search/stream, chunked until the client goes away, the
+        stub shuts down or the next streamPlan entry ends it
+        '''
+        with self.lock:
+            self.counts[STREAM] = self.counts.get(STREAM, 0) + 1
+            plan = self.streamPlan.pop(0) if self.streamPlan else None
+        if plan == 429:
+            data = b'{"title": "ConnectionException", "detail": "This stream is currently at the maximum allowed connection limit."}'
+            handler.send_response(429)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(data)))
+            handler.end_headers()
+            handler.wfile.write(data)
+            return
+        # subscribed before the client sees the 200, no tweet falls in between
+        q = queue.Queue()
+        with self.lock:
+            self.streams.append(q)
+
+        def write(data):
+            handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+        end = time.monotonic() + self.dropAfter if plan else None
+        lastWrite = time.monotonic()
+        try:
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Transfer-Encoding', 'chunked')
+            handler.end_headers()
+            while not self.closed.is_set():
+                now = time.monotonic()
+                if end and now >= end:
+                    break
+                timeout = self.keepAlive - (now - lastWrite)
+                if end:
+                    timeout = min(timeout, end - now)
+                try:
+                    write(q.get(timeout=max(timeout, 0)))
+                    lastWrite = time.monotonic()
+                except queue.Empty:
+                    if time.monotonic() - lastWrite >= self.keepAlive:
+                        write(b'\r\n')
+                        lastWrite = time.monotonic()
+        except OSError:
+            # the client went away
+            plan = 'drop'
+        finally:
+            with self.lock:
+                self.streams.remove(q)
+        if plan == 'stall':
+            # connected and silent, only the heartbeat of the client notices
+            self.closed.wait()
+        if plan:
+            # no last chunk, the client sees a broken response
+            handler.close_connection = True
+            return
+        write(b'')
+
+    def timeline(self, query) -> list:
+        count = int(query.get('count', 20))
+        sinceId = int(query.get('since_id', 0))
+        maxId = int(query.get('max_id', 0)) or float('inf')
+        with self.lock:
+            if 'screen_name' in query:
+                tweets = list(self.timelines.get(query['screen_name'], []))
+            else:
+                tweets = [t for l in self.timelines.values() for t in l]
+        tweets = [t for t in tweets if sinceId < t['id'] <= maxId]
+        tweets.sort(key=lambda t: t['id'], reverse=True)
+        tweets = tweets[:count]
+        if query.get('trim_user') == 'true':
+            tweets = [dict(t, user={'id': 1}) for t in tweets]
+        return tweets
+
+    def endpoint(self, method, path) -> str:
+        '''
+        return: endpoint name used for counts, latency and errorRate
+        '''
+        if path.startswith('/pbs.twimg.com/'):
+            return 'photo'
+        return '{} {}'.format(method, path.lstrip('/'))
+
+    def option(self, value, endpoint, default=0):
+        if isinstance(value, dict):
+            return value.get(endpoint, default)
+        return value
+
+    def handle(self, method, path, query, body):
+        '''
+        return: status, content type, body bytes
+        '''
+        endpoint = self.endpoint(method, path)
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        latency = self.option(self.latency, endpoint)
+        if latency:
+            time.sleep(latency)
+        if random.random() < self.option(self.errorRate, endpoint):
+            return 503, 'application/json', b'{"ok": 0, "errors": [{"message": "stub error"}]}'
+
+        if endpoint == 'photo':
+            # distinct content per url, no pic_id reuse between photos
+            return 200, 'image/jpeg', path.encode('utf-8') + self.photo
+        if endpoint == 'POST api.twitter.com/oauth2/token':
+            js = {'token_type': 'bearer', 'access_token': 'stub'}
+        elif endpoint in ('GET api.twitter.com/1.1/statuses/user_timeline.json',
+                          'GET api.twitter.com/1.1/lists/statuses.json'):
+            js = self.timeline(query)
+        elif endpoint == 'GET ' + STREAM_RULES:
+            with self.lock:
+                js = {'data': list(self.rules), 'meta': {'result_count': len(self.rules)}}
+        elif endpoint == 'POST ' + STREAM_RULES:
+            js = self.updateRules(body)
+        elif endpoint == 'POST api.weibo.com/2/statuses/share.json':
+            js = {'id': random.getrandbits(48), 'text': body.get('status', '')}
+        elif endpoint == 'GET m.weibo.cn/api/config':
+            js = {'data': {'st': 'stub', 'login': True}}
+        elif endpoint == 'POST m.weibo.cn/api/statuses/uploadPic':
+            js = {'pic_id': 'stub{:x}'.format(random.getrandbits(48))}
+        elif endpoint == 'POST m.weibo.cn/api/statuses/update':
+            js = {'ok': 1, 'data': {'id': str(random.getrandbits(48))}}
+        else:
+            return 404, 'application/json', b'{"errors": [{"message": "no stub"}]}'
+        return 200, 'application/json', json.dumps(js).encode('utf-8')
+
+    def serve(self, port=0):
+        '''
+        serve in a daemon thread, port 0 picks a free one
+        '''
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+            # headers and body are written apart, don't wait for delayed ACK
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                parts = urlsplit(self.path)
+                query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = {}
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    body = {k: v[-1] for k, v in parse_qs(raw.decode('utf-8')).items()}
+                elif self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw.decode('utf-8'))
+                if stub.endpoint(method, parts.path) == STREAM:
+                    stub.stream(self)
+                    return
+                status, contentType, data = stub.handle(method, parts.path, query, body)
+                self.send_response(status)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(data)))
+                if parts.path.startswith('/api.twitter.com/1.1/'):
+                    self.send_header('x-rate-limit-limit', str(RATE_LIMIT))
+                    self.send_header('x-rate-limit-remaining', str(RATE_LIMIT - 1))
+                    self.send_header('x-rate-limit-reset', str(int(time.time()) + 15 * 60))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='stub', daemon=True).start()
+        logging.info('stub on {}'.format(self.url))
+        return self
+
+    def routes(self) -> dict:
+        '''
+        return: routes for transport.route()
+        '''
+        return {host: self.url for host in HOSTS}
+
+    def shutdown(self):
+        self.closed.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+'''transport
+One pooled HTTP session shared by tweet, weibo and mweibo.
+Keep-alive connections are pooled per host, gzip/deflate responses are
+decoded by requests, and every request gets a (connect, read) timeout.
+see: https://requests.readthedocs.io/en/latest/user/advanced/#session-objects
+'''
+
+import json
+import logging
+import time
+import threading
+from http import cookiejar
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import deadline
+
+TIMEOUT = (5, 30)  # (connect, read) second
+POOL_CONNECTIONS = 8  # number of hosts to keep pools for
+POOL_MAXSIZE = 8  # keep-alive connections per host
+# hosts which go through config.PROXY
+TWITTER_HOSTS = ('api.twitter.com', 'pbs.twimg.com')
+
+_session = None
+_lock = threading.Lock()
+
+try:
+    # faster optional JSON parser
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout, or the one of the current deadline stage"""
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        # host -> base url, see route()
+        self.routes = {}
+        # capture.Recorder and capture.Replayer, see record() and replay()
+        self.recorder = None
+        self.replayer = None
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.replayer:
+            return self.replayer.respond(request)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = deadline.timeout() or self.timeout
+        if not self.recorder:
+            return self.forward(request, **kwargs)
+        url = request.url
+        start = time.time()
+        response = self.forward(request, **kwargs)
+        request.url = url  # record the url before routing
+        self.recorder.record(request, response, start, time.time() - start,
+                             stream=kwargs.get('stream', False))
+        return response
+
+    def forward(self, request, **kwargs):
+        if self.routes:
+            parts = urlsplit(request.url)
+            base = self.routes.get(parts.hostname)
+            if base:
+                # https://host/path?query -> base/host/path?query
+                request.url = '{}/{}{}{}'.format(
+                    base.rstrip('/'), parts.hostname, parts.path,
+                    '?' + parts.query if parts.query else '')
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def initHttp(proxy=None, timeout=TIMEOUT, poolSize=POOL_MAXSIZE) -> requests.Session:
+    session = requests.Session()
+    # credentials are passed per request, never share cookies between clients
+    session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = TimeoutHTTPAdapter(
+        timeout=timeout, pool_connections=POOL_CONNECTIONS, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if proxy:
+        setProxy(proxy, session=session)
+    return session
+
+
+def setProxy(proxy, hosts=TWITTER_HOSTS, session=None):
+    '''
+    route `hosts` through proxy, http(s):// or socks5://
+    '''
+    session = session or getSession()
+    if proxy.startswith('sock'):
+        try:
+            import socks
+        except ImportError:
+            raise Exception(
+                'PROXY setup failed! - ImportError! Please install requests[socks]. "pip install requests[socks]"')
+    elif not proxy.startswith('http'):
+        raise Exception('Unknown proxy {}'.format(proxy))
+    for host in hosts:
+        session.proxies['all://' + host] = proxy
+    logging.debug('proxy {} - {}'.format(proxy, ', '.join(hosts)))
+
+
+def route(routes, session=None):
+    '''
+    send the requests of some hosts to another server, e.g. local stubs
+    routes: {host: base url}, https://host/path goes to base url/host/path
+    '''
+    session = session or getSession()
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, TimeoutHTTPAdapter):
+            adapter.routes = dict(routes)
+    logging.debug('route {}'.format(routes))
+
+
+def record(path, binary=False, session=None):
+    '''
+    write every request and response to the JSONL file path, see capture.py
+    '''
+    import capture
+    session = session or getSession()
+    recorder = capture.Recorder(path, binary=binary)
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, TimeoutHTTPAdapter):
+            adapter.recorder = recorder
+    logging.info('record HTTP to {}'.format(path))
+    return recorder
+
+
+def replay(path, speed=1, session=None):
+    '''
+    answer every request from a file written by record(), nothing is sent
+    '''
+    import capture
+    session = session or getSession()
+    replayer = capture.Replayer(path, speed=speed)
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, TimeoutHTTPAdapter):
+            adapter.replayer = replayer
+    return replayer
+
+
+def getSession() -> requests.Session:
+    global _session
+    with _lock:
+        if _session is None:
+            _session = initHttp()
+        return _session
+
+
+def configure(proxy=None, timeout=TIMEOUT, poolSize=POOL_MAXSIZE) -> requests.Session:
+    '''
+    replace the shared session, call it before building clients
+    '''
+    global _session
+    session = initHttp(proxy, timeout, poolSize)
+    with _lock:
+        _session = session
+    return session
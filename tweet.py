@@ -10,41 +10,96 @@ import time
 import json
 import base64
 import logging
-import urllib3
-
-
-def initHttp(proxy=None):
-    if not proxy:
-        try:
-            import certifi
-            http = urllib3.PoolManager(
-                cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
-            return http
-        except ImportError:
-            logging.warn(
-                'certifi ImportError, Please install certifi. "pip install certifi"')
-            http = urllib3.PoolManager()
-            return http
-
-    if proxy.startswith('http'):
-        http = urllib3.ProxyManager(proxy)
-    elif proxy.startswith('sock'):
-        try:
-            from urllib3.contrib.socks import SOCKSProxyManager
-            http = SOCKSProxyManager(proxy)
-            return http
-        except ImportError:
-            raise Exception(
-                'PROXY setup failed! - ImportError! Please install urllib3[socks]. "pip install urllib3[socks]"')
-    else:
-        raise Exception('Unknown proxy {}'.format(proxy))
-    return http
+import datetime
+import threading
+
+import store
+import metrics
+import transport
+
+USER_TIMELINE_URL = 'https://api.twitter.com/1.1/statuses/user_timeline.json'
+LIST_TIMELINE_URL = 'https://api.twitter.com/1.1/lists/statuses.json'
+CATCHUP_COUNT = 200  # tweets per page past the first one, the most a timeline page holds
+
+
+class RateLimitError(Exception):
+    """HTTP 429, `reset` is the epoch second when the window resets"""
+
+    def __init__(self, reset):
+        super(RateLimitError, self).__init__('rate limit exceeded, reset at {}'.format(reset))
+        self.reset = reset
+
+
+def parseRateLimit(headers) -> dict:
+    '''
+    see: https://developer.twitter.com/en/docs/basics/rate-limiting
+    '''
+    try:
+        return {
+            'limit': int(headers['x-rate-limit-limit']),
+            'remaining': int(headers['x-rate-limit-remaining']),
+            'reset': int(headers['x-rate-limit-reset'])
+        }
+    except (KeyError, ValueError):
+        return None
+
+
+class TweetRecord(object):
+    """compact tweet parsed once at fetch time, the raw object is dropped"""
+
+    __slots__ = ('id', 'screenName', 'createdAt', 'text', 'photos',
+                 'isRetweet', 'isReply', 'lang')
+
+    def __init__(self, id, screenName=None, createdAt=0, text='', photos=(),
+                 isRetweet=False, isReply=False, lang=None):
+        self.id = id
+        self.screenName = screenName
+        self.createdAt = createdAt  # epoch second
+        self.text = text
+        self.photos = tuple(photos)  # media_url_https of photos
+        self.isRetweet = isRetweet
+        self.isReply = isReply
+        self.lang = lang
+
+    @classmethod
+    def fromJson(cls, t, screenName=None):
+        '''
+        v1.1 tweet object
+        see: https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/tweet-object
+        '''
+        createdAt = datetime.datetime.strptime(
+            t['created_at'], '%a %b %d %H:%M:%S %z %Y').timestamp()
+        media = t.get('extended_entities', {}).get('media', [])
+        return cls(
+            t['id'],
+            screenName=t.get('user', {}).get('screen_name') or screenName,
+            createdAt=createdAt,
+            text=t.get('full_text') or t.get('text') or '',
+            photos=[m.get('media_url_https') for m in media if m.get('type') == 'photo'],
+            isRetweet='retweeted_status' in t,
+            isReply=t.get('in_reply_to_status_id') is not None,
+            lang=t.get('lang'))
+
+    @classmethod
+    def fromDict(cls, d):
+        if 'createdAt' not in d:
+            # raw tweet object queued by an older version
+            return cls.fromJson(d)
+        return cls(**d)
+
+    def toDict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return 'TweetRecord({}, {})'.format(self.screenName, self.id)
 
 
 def filterTime(tweet, now, interval) -> bool:
-    created_at = time.strptime(
-        tweet['created_at'], '%a %b %d %H:%M:%S %z %Y')
-    diff = time.mktime(now) - time.mktime(created_at)  # second
+    '''
+    tweet: TweetRecord
+    now: epoch second
+    '''
+    diff = now - tweet.createdAt  # second
     if diff >= interval:
         return False
     return True
@@ -52,18 +107,19 @@ def filterTime(tweet, now, interval) -> bool:
 
 def hasImage(tweet) -> bool:
     '''
-    Tweet objects has photo (tweet -> extended_entities -> media -> type == 'photo')
+    TweetRecord has photo (tweet -> extended_entities -> media -> type == 'photo')
     see: https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/entities-object
     '''
-    if not 'extended_entities' in tweet or not 'media' in tweet['extended_entities']:
-        return False
-    return any(media['type'] == 'photo' for media in tweet['extended_entities']['media'])
+    return bool(tweet.photos)
 
 
 def getPhoto(url, proxy=None):
-    http = initHttp(proxy)
-    resp = http.request('GET', url)
-    return resp.data
+    if proxy:
+        transport.setProxy(proxy)
+    resp = transport.getSession().get(url)
+    # an error page is no photo, and must never end up in the media cache
+    resp.raise_for_status()
+    return resp.content
 
 
 class Tweet(object):
@@ -74,18 +130,78 @@ class Tweet(object):
         self.apiKey = kwargs.get('apiKey')
         self.apiSecret = kwargs.get('apiSecret')
         self._bearerToken = kwargs.get('bearerToken')
-        self.http = initHttp(kwargs.get('proxy'))
-        self.screenName = kwargs.get('screenName')
+        # credentials.CredentialStore, share the bearer token across runs
+        self.credentials = kwargs.get('credentials')
+        self.http = transport.getSession()
+        if kwargs.get('proxy'):
+            transport.setProxy(kwargs.get('proxy'), session=self.http)
+        # one screen name or a list of them
+        screenName = kwargs.get('screenName')
+        if isinstance(screenName, str):
+            screenName = [screenName]
+        self.screenNames = list(screenName or [])
+        self.screenName = self.screenNames[0] if self.screenNames else None
+        # list batch mode: read the timeline of a list with all the accounts
+        self.listId = kwargs.get('listId')
+        # lean timeline requests, see getNewTweets
+        self.trimUser = kwargs.get('trimUser', True)
+        self.excludeReplies = kwargs.get('excludeReplies', False)
+        self.includeRts = kwargs.get('includeRts', True)
         self.count = kwargs.get('count', 10)
         self.interval = kwargs.get('interval', 300)
+        self.maxPages = kwargs.get('maxPages', 16)
+        self.rateLimit = None  # last seen x-rate-limit-*
+        self.rateLimits = {}  # screen name -> last seen x-rate-limit-*
+        self.lock = threading.Lock()
+        # cursor mode: keep since_id high-water mark per screen name on disk,
+        # or in the shared store of the workers (get/set like store.StateFile)
+        stateFile = kwargs.get('stateFile')
+        self.state = kwargs.get('state')
+        if self.state is None and stateFile:
+            self.state = store.StateFile(stateFile)
 
     @property
     def bearerToken(self):
         if self._bearerToken:
             return self._bearerToken
-        self._bearerToken = self.refreshBearerToken()
+        with self.lock:
+            # refresh once for all the concurrent pollers
+            if not self._bearerToken and self.credentials:
+                self._bearerToken = self.credentials.fetch(
+                    'twitter', lambda: {'access_token': self.refreshBearerToken()})['access_token']
+            elif not self._bearerToken:
+                self._bearerToken = self.refreshBearerToken()
         return self._bearerToken
 
+    def resetBearerToken(self, token) -> bool:
+        '''
+        drop a bearer token rejected with HTTP 401
+        return: False if it can not be refreshed
+        '''
+        if not self.apiKey or not self.apiSecret:
+            return False
+        with self.lock:
+            if self._bearerToken == token:
+                self._bearerToken = None
+                if self.credentials:
+                    self.credentials.invalidate('twitter', {'access_token': token})
+        return True
+
+    def request(self, method, url, **kwargs):
+        '''
+        request with the bearer token, refresh it and replay once on HTTP 401
+        '''
+        headers = kwargs.pop('headers', {})
+        token = self.bearerToken
+        resp = self.http.request(
+            method, url, headers=dict(headers, Authorization='Bearer ' + token), **kwargs)
+        if resp.status_code == 401 and self.resetBearerToken(token):
+            logging.info('bearer token rejected, refresh and retry - {}'.format(url))
+            resp.close()
+            resp = self.http.request(
+                method, url, headers=dict(headers, Authorization='Bearer ' + self.bearerToken), **kwargs)
+        return resp
+
     def refreshBearerToken(self) -> str:
         '''
         TWITTER_API_KEY=XXXXXXXXXX
@@ -100,67 +216,250 @@ class Tweet(object):
             raise Exception('TWITTER_API_KEY or TWITTER_API_SECRET not found!')
         token = base64.b64encode(
             (apiKey + ':' + apiSecret).encode('utf-8')).decode('utf-8')
-        resp = self.http.urlopen(
-            'POST',
+        resp = self.http.post(
             'https://api.twitter.com/oauth2/token',
-            body='grant_type=client_credentials',
+            data='grant_type=client_credentials',
             headers={
                 'Authorization': 'Basic ' + token,
                 'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
             }
         )
-        data = json.loads(resp.data.decode('utf-8'))
+        data = json.loads(resp.content.decode('utf-8'))
         logging.debug('{} - {}'.format('refreshBearerToken', data))
         token = data.get('access_token')
         if not token:
-            raise Exception('refreshBearerToken fail - ' + data)
+            raise Exception('refreshBearerToken fail - ' + str(data))
         return token
 
-    def getNewTweets(self, count=None, interval=None) -> list:
+    def requestTimeline(self, fields, url=USER_TIMELINE_URL) -> list:
+        '''
+        GET statuses/user_timeline or lists/statuses, return None if request fail
+        return: TweetRecord list
+        '''
+        fields = dict(fields, tweet_mode='extended')
+        with metrics.timer('stage_seconds', stage='fetch'):
+            resp = self.request('GET', url, params=fields)
+        status = resp.status_code
+        rateLimit = parseRateLimit(resp.headers)
+        if rateLimit:
+            self.rateLimit = rateLimit
+            key = fields.get('screen_name') or 'list:{}'.format(fields.get('list_id'))
+            self.rateLimits[key] = rateLimit
+        if status == 429:
+            reset = rateLimit['reset'] if rateLimit else time.time() + 15 * 60
+            raise RateLimitError(reset)
+        if status != 200:
+            logging.warn("API status: {} - {}".format(str(status), resp.text))
+            return None
+        screenName = fields.get('screen_name')
+        with metrics.timer('stage_seconds', stage='decode'):
+            tweets = [TweetRecord.fromJson(t, screenName)
+                      for t in transport.loads(resp.content)]
+        logging.debug('API status: %s', status)
+        if rateLimit:
+            logging.debug('API rate: %s/%s', rateLimit['remaining'], rateLimit['limit'])
+        return tweets
+
+    def getNewTweets(self, count=None, interval=None, screenName=None) -> (list, dict):
         '''
         curl -x 'localhost:1080' 'https://api.twitter.com/1.1/statuses/user_timeline.json?screen_name=KanColle_STAFF&count=10&tweet_mode=extended' -v  -H "Authorization: Bearer $TWITTER_BEARER_TOKEN"
-        return new tweets
+        return new tweets, and the cursor to commit once they are queued
+        trim_user drops the user object embedded in every tweet,
+        exclude_replies and include_rts filter on the server,
+        in cursor mode on the client, see getTweetsSince
         see: https://developer.twitter.com/en/docs/tweets/timelines/api-reference/get-statuses-user_timeline.html
         '''
-        screenName = self.screenName
+        screenName = screenName or self.screenName
         count = count or self.count
         interval = interval if interval != None else self.interval
         if not screenName:
             raise Exception('screenName not found')
 
-        resp = self.http.request(
-            'GET',
-            'https://api.twitter.com/1.1/statuses/user_timeline.json',
-            fields={
-                'screen_name': screenName,
-                'count': count,
-                'tweet_mode': 'extended'
-            },
-            headers={
-                'Authorization': 'Bearer ' + self.bearerToken
-            }
-        )
-        tweets = json.loads(resp.data.decode('utf-8'))
-        status = resp.status
-        if not tweets or status != 200:
-            logging.warn("API status: {} - {}".format(str(status), resp.data.decode('utf-8')))
-            return []
-        ratelimit = resp.headers.get('x-rate-limit-limit')
-        ratelimit_r = resp.headers.get('x-rate-limit-remaining')
-        logging.debug("API status: " + str(status))
-        logging.debug("API rate: {}/{}".format(str(ratelimit_r), str(ratelimit)))
-
-        now = time.gmtime()
+        fields = {
+            'screen_name': screenName,
+            'trim_user': str(bool(self.trimUser)).lower(),
+            'exclude_replies': str(bool(self.excludeReplies)).lower(),
+            'include_rts': str(bool(self.includeRts)).lower()
+        }
+        return self.getTimeline(screenName, fields, count, interval)
+
+    def iterTimeline(self, screenName=None, maxId=None, count=200):
+        '''
+        backfill, the whole timeline newest first, one page in memory at a time
+        user_timeline only reaches back 3,200 tweets
+        maxId: resume below this id
+        yield: TweetRecord
+        see: https://developer.twitter.com/en/docs/tweets/timelines/guides/working-with-timelines
+        '''
+        screenName = screenName or self.screenName
+        if not screenName:
+            raise Exception('screenName not found')
+        # replies and retweets are dropped here, filtered on the server a page
+        # can be empty before the end
+        fields = {
+            'screen_name': screenName,
+            'count': count,
+            'trim_user': str(bool(self.trimUser)).lower(),
+            'exclude_replies': 'false',
+            'include_rts': 'true'
+        }
+        while True:
+            pageFields = dict(fields, max_id=maxId) if maxId else fields
+            try:
+                l = self.requestTimeline(pageFields)
+            except RateLimitError as e:
+                delay = max(e.reset - time.time(), 0) + 1
+                logging.warning('{} - rate limit exceeded, wait {:.0f}s'.format(screenName, delay))
+                time.sleep(delay)
+                continue
+            if l is None:
+                raise Exception('{} - timeline request fail below max_id {}'.format(screenName, maxId))
+            if not l:
+                return
+            for t in l:
+                if self.excludeReplies and t.isReply:
+                    continue
+                if not self.includeRts and t.isRetweet:
+                    continue
+                yield t
+            maxId = min(t.id for t in l) - 1
+
+    def getListTweets(self, listId=None, count=200, interval=None) -> (dict, dict):
+        '''
+        list batch mode, one paginated request for all the monitored accounts
+        curl 'https://api.twitter.com/1.1/lists/statuses.json?list_id=LIST_ID&count=200&tweet_mode=extended' -H "Authorization: Bearer $TWITTER_BEARER_TOKEN"
+        return: {screenName: new tweets}, only monitored accounts, and the cursor, see getTimeline
+        see: https://developer.twitter.com/en/docs/accounts-and-users/create-manage-lists/api-reference/get-lists-statuses
+        '''
+        listId = listId or self.listId
+        interval = interval if interval != None else self.interval
+        if not listId:
+            raise Exception('listId not found')
+        # no trim_user, the author is needed to split the list
+        tweets, cursor = self.getTimeline('list:{}'.format(listId), {
+            'list_id': listId,
+            'include_rts': str(bool(self.includeRts)).lower()
+        }, count, interval, url=LIST_TIMELINE_URL)
+
+        names = {name.lower(): name for name in self.screenNames}
+        groups = {}
+        for t in tweets:
+            name = names.get((t.screenName or '').lower())
+            if name:
+                groups.setdefault(name, []).append(t)
+        return groups, cursor
+
+    def getTimeline(self, key, fields, count, interval, url=USER_TIMELINE_URL) -> (list, dict):
+        '''
+        key: cursor name, screen name or list:<list_id>
+        return: new tweets, oldest first, and the cursor, state changes which
+        are only saved by commitCursor once the tweets are queued
+        raise: a failed request, no new tweets is an empty list
+        '''
+        if self.state is not None:
+            return self.getTweetsSince(key, fields, count, interval, url)
+
+        tweets = self.requestTimeline(dict(fields, count=count), url)
+        if tweets is None:
+            raise Exception('{} - timeline request fail'.format(key))
+        if not tweets:
+            return [], {}
+
+        now = time.time()
         if interval > 0:
             newList = list(
                 filter(lambda tweet: filterTime(tweet, now, interval), tweets))
         else:
             newList = tweets
         if not newList:
-            return []
+            return [], {}
         newList.reverse()
-        logging.debug('new tweet - ' + str(newList))
-        return newList
+        logging.debug('new tweet - %s', newList)
+        return newList, {}
+
+    def commitCursor(self, cursor):
+        '''
+        save the cursor of getTimeline, after its tweets are in the outbox
+        '''
+        for key, value in cursor.items():
+            self.state.set(key, value)
+
+    def getTweetsSince(self, name, fields, count, interval, url=USER_TIMELINE_URL) -> (list, dict):
+        '''
+        cursor mode, only ask for tweets newer than the saved since_id
+        and page backward with max_id when more than `count` arrived.
+        Past `maxPages` the position is kept under catchup:<name> and the
+        next call goes on with the older tweets.
+        Nothing is saved here, the returned cursor is committed by the caller
+        see: https://developer.twitter.com/en/docs/tweets/timelines/guides/working-with-timelines
+        '''
+        key = 'since_id:' + name
+        sinceId = self.state.get(key)
+        if not sinceId:
+            # first run, no high-water mark yet. fallback to time window
+            tweets = self.requestTimeline(dict(fields, count=count), url)
+            if tweets is None:
+                raise Exception('{} - timeline request fail'.format(name))
+            cursor = {key: max(t.id for t in tweets)} if tweets else {}
+            now = time.time()
+            newList = [t for t in tweets if interval <= 0 or filterTime(t, now, interval)]
+            newList.reverse()
+            return newList, cursor
+
+        # filtered on the server a page of replies or retweets comes back short
+        # or empty before the end, page the whole timeline and filter here
+        excludeReplies = fields.get('exclude_replies') == 'true'
+        excludeRts = fields.get('include_rts') == 'false'
+        fields = dict(fields)
+        if 'exclude_replies' in fields:
+            fields['exclude_replies'] = 'false'
+        if 'include_rts' in fields:
+            fields['include_rts'] = 'true'
+        # an unfinished catch-up goes on below the oldest tweet fetched last time,
+        # since_id only moves once the whole range above it was fetched
+        gapKey = 'catchup:' + name
+        gap = self.state.get(gapKey) or {}
+        maxId = gap.get('maxId')
+        pageCount = CATCHUP_COUNT if maxId else count
+        tweets = {}
+        caughtUp = True
+        for page in range(self.maxPages):
+            pageFields = dict(fields, count=pageCount, since_id=sinceId)
+            if maxId:
+                pageFields['max_id'] = maxId
+            l = self.requestTimeline(pageFields, url)
+            if l is None:
+                # the cursor is kept, the whole range is retried next time
+                raise Exception('{} - timeline request fail after {} pages'.format(name, page))
+            for t in l:
+                tweets[t.id] = t
+            if len(l) < pageCount:
+                break
+            maxId = min(t.id for t in l) - 1
+            # more than `count` new tweets, catch up with full pages
+            pageCount = CATCHUP_COUNT
+        else:
+            caughtUp = False
+
+        highId = max([gap.get('highId') or 0] + list(tweets))
+        cursor = {}
+        if not caughtUp:
+            cursor[gapKey] = {'maxId': maxId, 'highId': highId}
+            logging.warn('{} - more than {} pages of new tweets, tweets older than {} are fetched next time'.format(
+                name, self.maxPages, maxId + 1))
+        else:
+            if highId:
+                cursor[key] = highId
+            if gap:
+                cursor[gapKey] = None
+
+        # the cursor above counts the filtered tweets too
+        newList = [tweets[i] for i in sorted(tweets)
+                   if not (excludeReplies and tweets[i].isReply)
+                   and not (excludeRts and tweets[i].isRetweet)]
+        if newList:
+            logging.debug('new tweet - %s', newList)
+        return newList, cursor
 
 
 def test():
@@ -174,7 +473,7 @@ def test():
     }
 
     tweet = Tweet(**payload)
-    t = tweet.getNewTweets(interval=0)
+    t, _ = tweet.getNewTweets(interval=0)
     print(str(t))
 
 
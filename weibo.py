@@ -18,13 +18,19 @@ except ImportError:
 
 import json
 import time
+import hashlib
+import logging
 
-import requests
+import transport
+
+# expired, revoked or invalid access_token
+# see: https://open.weibo.com/wiki/Error_code
+TOKEN_ERRORS = (21314, 21315, 21316, 21317, 21327, 21332)
 
 
 class Client(object):
     def __init__(self, api_key, api_secret, redirect_uri, token=None,
-                 username=None, password=None):
+                 username=None, password=None, credentials=None):
         # const define
         self.site = 'https://api.weibo.com/'
         self.authorization_url = self.site + 'oauth2/authorize'
@@ -36,9 +42,26 @@ class Client(object):
         self.client_secret = api_secret
         self.redirect_uri = redirect_uri
 
-        self.session = requests.session()
+        # shared pooled session, keep auth and params per client
+        self.session = transport.getSession()
+        self.auth = None
+        self.params = {}
         if username and password:
-            self.session.auth = username, password
+            self.auth = username, password
+
+        # credentials.CredentialStore, shared with other workers
+        self.credentials = credentials
+        # one entry per account, the destinations may share one app
+        account = username or (token or {}).get('access_token')
+        self.credential_key = 'weibo:' + str(api_key)
+        if account:
+            self.credential_key += ':' + hashlib.sha1(account.encode('utf-8')).hexdigest()[:12]
+        self.token = None
+        self.uid = None
+        self.access_token = None
+        self.expires_at = None
+        if not token and credentials:
+            token = credentials.get(self.credential_key)
 
         # activate client directly if given token
         if token:
@@ -69,12 +92,14 @@ class Client(object):
             'code': authorization_code,
             'redirect_uri': self.redirect_uri
         }
-        res = requests.post(self.token_url, data=params)
+        res = self.session.post(self.token_url, data=params)
         token = json.loads(res.text)
         self._assert_error(token)
 
         token[u'expires_at'] = int(time.time()) + int(token.pop(u'expires_in'))
         self.set_token(token)
+        if self.credentials:
+            self.credentials.set(self.credential_key, token)
 
     def set_token(self, token):
         """Directly activate client by access_token.
@@ -85,7 +110,7 @@ class Client(object):
         self.access_token = token.get('access_token')
         self.expires_at = token.get('expires_at')
 
-        self.session.params = {'access_token': self.access_token}
+        self.params = {'access_token': self.access_token}
 
     def _assert_error(self, d):
         """Assert if json response is error.
@@ -94,18 +119,65 @@ class Client(object):
             raise RuntimeError("{0} {1}".format(
                 d.get("error_code", ""), d.get("error", "")))
 
+    def _is_token_error(self, d):
+        try:
+            return int(d.get('error_code', 0)) in TOKEN_ERRORS
+        except (TypeError, ValueError):
+            return False
+
+    def _reload_token(self, rejected=False):
+        """Pick up a token renewed by another worker from the store.
+
+        Weibo OAuth has no refresh grant, a new token only comes from
+        `set_code`, so return False when the store holds nothing newer.
+        """
+        if not self.credentials:
+            return False
+        if rejected and self.token:
+            self.credentials.invalidate(self.credential_key, self.token)
+        token = self.credentials.get(self.credential_key)
+        if not token or token.get('access_token') == self.access_token:
+            return False
+        self.set_token(token)
+        return True
+
+    def _check_token(self):
+        """Renew the token ahead of expiry when possible.
+        """
+        if not self.expires_at or not self.access_token:
+            return
+        margin = self.credentials.margin if self.credentials else 0
+        if self.expires_at - margin > time.time():
+            return
+        if not self._reload_token():
+            logging.warning('weibo access_token expires at {0}, authorize again'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.expires_at))))
+
+    def _request(self, method, url, query=None, **kwargs):
+        """Send request, reload the token and replay once on token error.
+        """
+        self._check_token()
+        res = json.loads(self.session.request(
+            method, url, params=dict(self.params, **(query or {})),
+            auth=self.auth, **kwargs).text)
+        if self._is_token_error(res) and self._reload_token(rejected=True):
+            logging.info('weibo access_token reloaded, replay {0}'.format(url))
+            res = json.loads(self.session.request(
+                method, url, params=dict(self.params, **(query or {})),
+                auth=self.auth, **kwargs).text)
+        self._assert_error(res)
+        return res
+
     def get(self, uri, **kwargs):
         """Request resource by get method.
         """
         url = "{0}{1}.json".format(self.api_url, uri)
 
         # for username/password client auth
-        if self.session.auth:
+        if self.auth:
             kwargs['source'] = self.client_id
 
-        res = json.loads(self.session.get(url, params=kwargs).text)
-        self._assert_error(res)
-        return res
+        return self._request('GET', url, query=kwargs)
 
     def post(self, uri, **kwargs):
         """Request resource by post method.
@@ -113,18 +185,13 @@ class Client(object):
         url = "{0}{1}.json".format(self.api_url, uri)
 
         # for username/password client auth
-        if self.session.auth:
+        if self.auth:
             kwargs['source'] = self.client_id
 
         if "pic" not in kwargs:
-            res = json.loads(self.session.post(url, data=kwargs).text)
-        else:
-            files = {"pic": kwargs.pop("pic")}
-            res = json.loads(self.session.post(url,
-                                               data=kwargs,
-                                               files=files).text)
-        self._assert_error(res)
-        return res
+            return self._request('POST', url, data=kwargs)
+        files = {"pic": kwargs.pop("pic")}
+        return self._request('POST', url, data=kwargs, files=files)
 
     def shareWeibo(self, status, pic=None, redirect_uri=None):
         if redirect_uri: